@@ -19,6 +19,7 @@
 import os
 import time
 import shutil
+from operator import itemgetter
 from gettext import gettext as _
 import logging
 
@@ -51,6 +52,9 @@ from sugar3.datastore import datastore
 
 from imagecanvas import ImageCanvas
 from imagechooser import ImageFileChooser
+from iconview import PREVIEW_SIZE
+import mediacatalog
+import thumbnailcache
 from bookmodel import BookModel
 from previewpanel import PreviewPanel
 from epubfactory import create_ebub_from_book_model
@@ -67,6 +71,15 @@ SCRATCH_COSTUMES_PATH = SCRATCH_PATH + '/Media/Costumes'
 
 TUXPAINT_STAMPS_PATH = '/usr/share/tuxpaint/stamps'
 
+# time without new allocations before resizing the canvas, in ms
+RESIZE_DELAY = 100
+
+# number of thumbnails created for every category when the activity
+# starts, about the first screen of the chooser
+WARM_UP_THUMBNAILS = 24
+# time between the checks while the warm up is paused, in ms
+WARM_UP_WAIT = 1000
+
 
 class WriteBooksActivity(activity.Activity):
 
@@ -75,6 +88,10 @@ class WriteBooksActivity(activity.Activity):
 
         self._book_model = BookModel()
         self._actual_page = 1
+        self._prefetch_requests = []
+        self._canvas_size = None
+        self._resize_timeout_id = None
+        self._chooser_open = False
 
         # we do not have collaboration features
         # make the share option insensitive
@@ -196,6 +213,63 @@ class WriteBooksActivity(activity.Activity):
         self.show_all()
         self._preview_panel.hide()
 
+        # prepare the media categories for the choosers, in idle time
+        # after the first page is displayed
+        self._warm_up = self._warm_up_categories()
+        GObject.idle_add(self.__warm_up_cb, priority=GObject.PRIORITY_LOW)
+
+    def _warm_up_categories(self):
+        """
+        Index the media categories and create the thumbnails of the
+        first screen of every category. Is a generator, doing a small
+        step every time is called, and yielding the time to wait before
+        the next step, in ms.
+        The thumbnails of a category are created after the ones of the
+        previous category were finished, and the work is paused while
+        a chooser is open, to not compete with the user interface.
+        """
+        catalog = mediacatalog.get_catalog(self._translations)
+        for categories in (self._get_background_categories(),
+                           self._get_image_categories()):
+            for category, category_paths in categories.items():
+                catalog.add_category(category, category_paths)
+                while self._chooser_open:
+                    yield WARM_UP_WAIT
+                if catalog.is_updated(category):
+                    # was opened in a chooser
+                    continue
+                for step in catalog.update_category(category):
+                    yield 0
+                    while self._chooser_open:
+                        yield WARM_UP_WAIT
+                while self._chooser_open or \
+                        thumbnailcache.is_creating_thumbnails():
+                    yield WARM_UP_WAIT
+                # the chooser displays first the newer files
+                entries = sorted(catalog.get_entries(category),
+                                 key=itemgetter('mtime'), reverse=True)
+                thumbnailcache.create_thumbnails(
+                    [(entry['path'], entry['mtime'], entry['size'])
+                     for entry in entries[:WARM_UP_THUMBNAILS]],
+                    PREVIEW_SIZE[0], PREVIEW_SIZE[1])
+                yield 0
+        catalog.save()
+
+    def __warm_up_cb(self):
+        wait = next(self._warm_up, None)
+        if wait is None:
+            # finished
+            return False
+        if wait > 0:
+            # check again later, without using the cpu while waiting
+            GObject.timeout_add(wait, self.__warm_up_resume_cb)
+            return False
+        return True
+
+    def __warm_up_resume_cb(self):
+        GObject.idle_add(self.__warm_up_cb, priority=GObject.PRIORITY_LOW)
+        return False
+
     def create_edition_canvas(self):
         self._image_canvas = ImageCanvas()
         self._image_canvas.connect('images-modified',
@@ -245,14 +319,30 @@ class WriteBooksActivity(activity.Activity):
     def __background_size_allocate_cb(self, widget, allocation):
         height = allocation.height / 4 * 3
         width = height / 3 * 4
+        if (width, height) == self._canvas_size:
+            return
+        self._canvas_size = (width, height)
+        # toggling the preview panel or rotating the screen produce
+        # many allocations, only the last size is applied
+        if self._resize_timeout_id is not None:
+            GObject.source_remove(self._resize_timeout_id)
+        self._resize_timeout_id = GObject.timeout_add(
+            RESIZE_DELAY, self.__resize_canvas_cb, widget)
+
+    def __resize_canvas_cb(self, widget):
+        self._resize_timeout_id = None
+        width, height = self._canvas_size
         logging.debug('size allocate %s x %s', width, height)
         self._image_canvas.set_size_request(width, height)
         widget.check_resize()
+        return False
 
     def __view_list_toggled_cb(self, button):
         if button.get_active():
-            self._preview_panel.update_model(self._book_model.get_pages())
+            # the thumbnails are rendered only while the panel is visible
             self._preview_panel.show()
+            self._preview_panel.update_model(self._book_model.get_pages(),
+                                             self._actual_page)
             self._image_canvas.set_editable(False)
             self._text_editor.set_editable(False)
             self._scrolled_window.set_size_request(
@@ -268,11 +358,17 @@ class WriteBooksActivity(activity.Activity):
 
     def write_file(self, file_path):
         self._book_model.write(file_path)
+        # the outdated thumbnails are not stored, and are prepared
+        # to be stored the next time
+        self._preview_panel.render_missing_thumbnails(
+            self._book_model.get_pages())
         self.metadata['mime_type'] = 'application/x-writebooks-activity'
 
     def read_file(self, file_path):
-        self._book_model.read(file_path)
+        self._book_model.read(file_path, self.__image_trimmed_cb)
         self._update_page_buttons()
+        self._preview_panel.render_missing_thumbnails(
+            self._book_model.get_pages())
 
     def prepare_edit_toolbar(self):
         self._edit_toolbar.copy.connect('clicked', self.__copy_clicked_cb)
@@ -301,14 +397,16 @@ class WriteBooksActivity(activity.Activity):
     def __redo_clicked_cb(self, button):
         self._text_editor.get_buffer().redo()
 
-    def __set_background_clicked_cb(self, button):
-        categories = {
+    def _get_background_categories(self):
+        return {
             _('Indoors'): [os.path.join(SCRATCH_BACKGROUNDS_PATH, 'Indoors')],
             _('Nature'): [os.path.join(SCRATCH_BACKGROUNDS_PATH, 'Nature')],
             _('Outdoors'):
                 [os.path.join(SCRATCH_BACKGROUNDS_PATH, 'Outdoors')],
             _('Sports'): [os.path.join(SCRATCH_BACKGROUNDS_PATH, 'Sports')]}
 
+    def __set_background_clicked_cb(self, button):
+        categories = self._get_background_categories()
         chooser = ImageFileChooser(image_type='backgrounds',
                                    title=_('Select a background'),
                                    categories=categories,
@@ -318,10 +416,12 @@ class WriteBooksActivity(activity.Activity):
         chooser.connect('response', self.__chooser_response_cb,
                         self._change_background)
         self.set_sensitive(False)
+        self._chooser_open = True
         chooser.show()
 
     def __chooser_response_cb(self, chooser, response_id, operation_function):
         self.set_sensitive(True)
+        self._chooser_open = False
         if response_id == Gtk.ResponseType.ACCEPT:
             logging.error('selected %s', chooser.get_selected_object_id())
             file_path = chooser.get_selected_object_id()
@@ -363,8 +463,8 @@ class WriteBooksActivity(activity.Activity):
         self._book_model.set_page_background(self._actual_page, file_name)
         self._update_page_view()
 
-    def __add_image_clicked_cb(self, button):
-        categories = {
+    def _get_image_categories(self):
+        return {
             _('Animals'): [os.path.join(SCRATCH_COSTUMES_PATH, 'Animals'),
                            os.path.join(TUXPAINT_STAMPS_PATH, 'animals')],
             _('Fantasy'): [os.path.join(SCRATCH_COSTUMES_PATH, 'Fantasy'),
@@ -382,6 +482,8 @@ class WriteBooksActivity(activity.Activity):
                 os.path.join(SCRATCH_COSTUMES_PATH, 'Transportation'),
                 os.path.join(TUXPAINT_STAMPS_PATH, 'vehicles')]}
 
+    def __add_image_clicked_cb(self, button):
+        categories = self._get_image_categories()
         chooser = ImageFileChooser(image_type='actors',
                                    title=_('Select an image to add'),
                                    categories=categories,
@@ -391,13 +493,20 @@ class WriteBooksActivity(activity.Activity):
         chooser.connect('response', self.__chooser_response_cb,
                         self._add_image)
         self.set_sensitive(False)
+        self._chooser_open = True
         chooser.show()
 
     def _add_image(self, file_name):
         logging.error('Add image %s', file_name)
-        self._book_model.add_image(self._actual_page, file_name)
+        self._book_model.add_image(self._actual_page, file_name,
+                                   self.__image_trimmed_cb)
         self._update_page_view()
 
+    def __image_trimmed_cb(self, page, image):
+        if page is self._book_model.get_page_model(self._actual_page):
+            self._image_canvas.update_trim(image)
+        self._preview_panel.update_page(page)
+
     def __remove_clicked_cb(self, file_name):
         if self._image_canvas.is_image_active():
             alert = ConfirmationAlert()
@@ -427,10 +536,13 @@ class WriteBooksActivity(activity.Activity):
                 if self._actual_page > len(self._book_model.get_pages()):
                     self._actual_page -= 1
                 self._update_page_buttons()
-                self._preview_panel.update_model(self._book_model.get_pages())
+                self._preview_panel.update_model(self._book_model.get_pages(),
+                                                 self._actual_page)
 
     def __images_modified_cb(self, canvas, images_views):
         self._book_model.update_images(self._actual_page, images_views)
+        self._preview_panel.update_page(
+            self._book_model.get_page_model(self._actual_page))
 
     def _update_page_buttons(self):
         cant_pages = len(self._book_model.get_pages())
@@ -448,19 +560,39 @@ class WriteBooksActivity(activity.Activity):
         self._text_editor.set_text(page_model.text)
         self._text_changed_signal_id = self._text_editor.connect(
             'changed', self.__text_changed_cb)
+        self._preview_panel.update_page(page_model)
+        self._prefetch_neighbor_pages()
+
+    def _prefetch_neighbor_pages(self):
+        # decode the images of the previous and next pages in the
+        # background, to show them quickly if the user move to them
+        requests = []
+        pages = self._book_model.get_pages()
+        for page_number in (self._actual_page + 1, self._actual_page - 1):
+            if 1 <= page_number <= len(pages):
+                page_model = self._book_model.get_page_model(page_number)
+                requests.extend(self._image_canvas.prefetch(
+                    page_model.background_path, page_model.images))
+        # cancel the old requests after adding the new ones,
+        # to not lose the work already done for images shared by both
+        for request in self._prefetch_requests:
+            request.cancel()
+        self._prefetch_requests = requests
 
     def __add_page_clicked_cb(self, button):
         self._book_model.add_page()
         self._actual_page = len(self._book_model.get_pages())
         self._update_page_buttons()
-        self._preview_panel.update_model(self._book_model.get_pages())
+        self._preview_panel.update_model(self._book_model.get_pages(),
+                                         self._actual_page)
 
     def __duplicate_page_clicked_cb(self, button):
         actual_page_model = self._book_model.get_page_model(self._actual_page)
         self._book_model.add_page(actual_page_model)
         self._actual_page = len(self._book_model.get_pages())
         self._update_page_buttons()
-        self._preview_panel.update_model(self._book_model.get_pages())
+        self._preview_panel.update_model(self._book_model.get_pages(),
+                                         self._actual_page)
 
     def __next_page_clicked_cb(self, button):
         self._actual_page += 1
@@ -486,11 +618,14 @@ class WriteBooksActivity(activity.Activity):
         self._actual_page = new_order_actual_page + 1
         self._book_model.set_pages(new_pages)
         self._update_page_buttons()
-        preview_panel.update_model(self._book_model.get_pages())
+        preview_panel.update_model(self._book_model.get_pages(),
+                                   self._actual_page)
 
     def __text_changed_cb(self, texteditor):
         self._book_model.set_page_text(self._actual_page,
                                        texteditor.get_text())
+        self._preview_panel.update_page(
+            self._book_model.get_page_model(self._actual_page))
 
     def __save_ebook_clicked_cb(self, button):
         alert = Alert()
@@ -1,11 +1,43 @@
 # the book model
+import cairo
+import glob
 import logging
 import os
 import json
+import threading
 import zipfile
 
 from sugar3.activity import activity
 
+import imageloader
+from pagerenderer import get_page_hash
+from pagerenderer import get_page_key
+
+# proportions of the canvas, used to convert between the percentages
+# of width and height when a rotated image is trimmed
+REFERENCE_WIDTH = 4.
+REFERENCE_HEIGHT = 3.
+
+
+def get_thumbnail_path(page_hash):
+    instance_path = os.path.join(activity.get_activity_root(), 'instance')
+    return os.path.join(instance_path, 'thumbnail_%s.png' % page_hash)
+
+
+def write_thumbnail(surface, page_hash):
+    """
+    Write the thumbnail of a page to a png file and return the path,
+    can be called from any thread
+    """
+    thumbnail_path = get_thumbnail_path(page_hash)
+    # write to other file and rename, because the same thumbnail can be
+    # written by the preview panel and when the book is saved
+    temp_path = '%s.%d.tmp' % (thumbnail_path,
+                               threading.current_thread().ident)
+    surface.write_to_png(temp_path)
+    os.rename(temp_path, thumbnail_path)
+    return thumbnail_path
+
 
 class BookModel():
 
@@ -24,6 +56,8 @@ class BookModel():
         if page is not None:
             new_page.background_path = page.background_path
             new_page.text = page.text
+            new_page.thumbnail_path = page.thumbnail_path
+            new_page.thumbnail_hash = page.thumbnail_hash
             # clone the content of the images array
             # to avoid have the 2 pages pointing to the same
             # image objects
@@ -38,6 +72,8 @@ class BookModel():
                 new_image.h_mirrored = image.h_mirrored
                 new_image.v_mirrored = image.v_mirrored
                 new_image.angle = image.angle
+                new_image.trim = image.trim
+                new_image.trim_pending = image.trim_pending
                 new_page.images.append(new_image)
 
         self._pages.append(new_page)
@@ -58,11 +94,39 @@ class BookModel():
     def set_page_text(self, page_number, text):
         self._pages[page_number - 1].text = text
 
-    def add_image(self, page_number, path):
+    def add_image(self, page_number, path, trimmed_cb=None):
+        """
+        trimmed_cb -- if set, is called with the page and the image
+            when the trim of the image is found
+        """
         page = self._pages[page_number - 1]
         image = Image()
         image.path = path
+        # the transparent margins are not drawn or used to select the image
+        image.trim_pending = True
         page.images.append(image)
+        self._find_trim(path, trimmed_cb)
+
+    def _find_trim(self, path, trimmed_cb):
+        # decoding the image is slow, then is done in the background
+        imageloader.load_opaque_bounds_async(
+            path, lambda path, trim: self._apply_trim(path, trim, trimmed_cb))
+
+    def _apply_trim(self, path, trim, trimmed_cb):
+        # the images can be copied or the book read again while the
+        # trim was searched, then all the pending images are updated
+        for page in self._pages:
+            for image in page.images:
+                if image.path != path or not image.trim_pending:
+                    continue
+                image.trim_pending = False
+                if image.width == 0 or image.height == 0:
+                    # the size is set from the trimmed size when displayed
+                    image.trim = trim
+                else:
+                    image.apply_trim(trim)
+                if trimmed_cb is not None:
+                    trimmed_cb(page, image)
 
     def update_images(self, page_number, images_views):
         page = self._pages[page_number - 1]
@@ -86,10 +150,19 @@ class BookModel():
         book_data['cover_path'] = self.cover_path
 
         pages = []
+        # the thumbnails to add to the bundle, by file name
+        thumbnails = {}
         for page in self._pages:
             page_data = {}
             page_data['text'] = page.text
             page_data['background_path'] = page.background_path
+            # the outdated thumbnails are not stored, they are rendered
+            # by the preview panel when the book is displayed
+            page_hash = page.get_hash()
+            if page.has_thumbnail(page_hash):
+                thumbnails['thumbnail_%s.png' % page_hash] = \
+                    page.thumbnail_path
+                page_data['thumbnail_hash'] = page_hash
             page_data['images'] = []
             for image in page.images:
                 image_data = {}
@@ -101,6 +174,9 @@ class BookModel():
                 image_data['h_mirrored'] = image.h_mirrored
                 image_data['v_mirrored'] = image.v_mirrored
                 image_data['angle'] = image.angle
+                # if the trim was not found yet, is searched when read
+                if not image.trim_pending:
+                    image_data['trim'] = image.trim
                 page_data['images'].append(image_data)
             pages.append(page_data)
         book_data['pages'] = pages
@@ -118,6 +194,10 @@ class BookModel():
         z = zipfile.ZipFile(file_path, 'w')
         z.write(os.path.join(instance_path, data_file_name), data_file_name)
 
+        for file_name, thumbnail_path in thumbnails.items():
+            z.write(thumbnail_path, file_name)
+        self._remove_old_thumbnails(instance_path, thumbnails)
+
         # zip the cover image
         if self.cover_path and os.path.exists(self.cover_path):
             z.write(self.cover_path, os.path.basename(self.cover_path))
@@ -133,7 +213,21 @@ class BookModel():
                     z.write(image.path, os.path.basename(image.path))
         z.close()
 
-    def read(self, file_path):
+    def _remove_old_thumbnails(self, instance_path, thumbnails):
+        """Remove the thumbnail files not used by the pages"""
+        for thumbnail_path in glob.glob(os.path.join(instance_path,
+                                                     'thumbnail_*.png')):
+            if os.path.basename(thumbnail_path) not in thumbnails:
+                try:
+                    os.remove(thumbnail_path)
+                except OSError:
+                    logging.exception('Error removing %s', thumbnail_path)
+
+    def read(self, file_path, trimmed_cb=None):
+        """
+        trimmed_cb -- if set, is called with the page and the image
+            when the trim of a image saved by older versions is found
+        """
         instance_path = os.path.join(activity.get_activity_root(), 'instance')
         z = zipfile.ZipFile(file_path, 'r')
         for file_path in z.namelist():
@@ -158,10 +252,16 @@ class BookModel():
 
         self.cover_path = book_data['cover_path']
         self._pages = []
+        # the images saved by older versions need to be trimmed
+        untrimmed_paths = set()
         for page_data in book_data['pages']:
             page = Page()
             page.background_path = page_data['background_path']
             page.text = page_data['text']
+            if 'thumbnail_hash' in page_data:
+                # the thumbnail is decoded when is needed
+                page.thumbnail_hash = page_data['thumbnail_hash']
+                page.thumbnail_path = get_thumbnail_path(page.thumbnail_hash)
             page.images = []
             for image_data in page_data['images']:
                 image = Image()
@@ -173,8 +273,16 @@ class BookModel():
                 image.h_mirrored = image_data['h_mirrored']
                 image.v_mirrored = image_data['v_mirrored']
                 image.angle = image_data['angle']
+                if 'trim' in image_data:
+                    if image_data['trim'] is not None:
+                        image.trim = tuple(image_data['trim'])
+                else:
+                    image.trim_pending = True
+                    untrimmed_paths.add(image.path)
                 page.images.append(image)
             self._pages.append(page)
+        for path in untrimmed_paths:
+            self._find_trim(path, trimmed_cb)
 
 
 class Page():
@@ -183,6 +291,60 @@ class Page():
         self.background_path = None
         self.images = []
         self.text = ''
+        # the png file with a small image of the page, and the hash
+        # of the page content when was rendered, the thumbnail is
+        # outdated if the hash changed
+        self.thumbnail_path = None
+        self.thumbnail_hash = None
+
+    def get_hash(self):
+        return get_page_hash(get_page_key(self.background_path, self.images))
+
+    def set_thumbnail(self, thumbnail_path, thumbnail_hash, pages=()):
+        """
+        Set the thumbnail rendered, and remove the file of the old one
+        if is not used by other page
+        pages -- the pages of the book
+        """
+        old_path = self.thumbnail_path
+        self.thumbnail_path = thumbnail_path
+        self.thumbnail_hash = thumbnail_hash
+        if old_path is None or old_path == thumbnail_path:
+            return
+        for page in pages:
+            if page is not self and page.thumbnail_path == old_path:
+                return
+        try:
+            os.remove(old_path)
+        except OSError:
+            # the file was not written yet, or was already removed
+            pass
+
+    def has_thumbnail(self, page_hash=None):
+        """
+        Return True if the thumbnail file is updated
+        page_hash -- the hash of the page, if was already calculated
+        """
+        if page_hash is None:
+            page_hash = self.get_hash()
+        return self.thumbnail_hash == page_hash and \
+            self.thumbnail_path is not None and \
+            os.path.exists(self.thumbnail_path)
+
+    def load_thumbnail(self):
+        """
+        Return a ImageSurface with the thumbnail if is updated, or None.
+        The thumbnail is not kept, the caller decides if cache it.
+        """
+        if not self.has_thumbnail():
+            return None
+        try:
+            return cairo.ImageSurface.create_from_png(self.thumbnail_path)
+        except Exception:
+            logging.exception('Error reading thumbnail %s',
+                              self.thumbnail_path)
+            self.thumbnail_hash = None
+            return None
 
 
 class Image():
@@ -197,3 +359,47 @@ class Image():
         self.h_mirrored = False
         self.v_mirrored = False
         self.angle = 0
+        # the part of the image used, (x, y, width, height) as fractions
+        # of the image size, or None to use the whole image
+        self.trim = None
+        # True while the trim is searched in the background
+        self.trim_pending = False
+
+    def apply_trim(self, trim):
+        """
+        Set the trim of a image that was added without it, changing the
+        position and size to keep the trimmed part in the same place.
+        If the size is not defined, the image is not trimmed, because
+        the size depends on the size of the canvas.
+        """
+        if trim is None or self.width == 0 or self.height == 0:
+            return
+        trim_x, trim_y, trim_width, trim_height = trim
+        # the mirror is applied to the image before the rotation
+        h_mirrored, v_mirrored = self.h_mirrored, self.v_mirrored
+        if self.angle == 90 or self.angle == 270:
+            h_mirrored, v_mirrored = v_mirrored, h_mirrored
+        if h_mirrored:
+            trim_x = 1 - trim_x - trim_width
+        if v_mirrored:
+            trim_y = 1 - trim_y - trim_height
+
+        # position of the trimmed part in the box, before the rotation
+        width = self.width * REFERENCE_WIDTH
+        height = self.height * REFERENCE_HEIGHT
+        offset_x, offset_y = trim_x * width, trim_y * height
+        new_width, new_height = trim_width * width, trim_height * height
+        # and after the rotation, as done by pagerenderer.draw_image
+        if self.angle == 90:
+            offset_x, offset_y = height - offset_y - new_height, offset_x
+        elif self.angle == 180:
+            offset_x, offset_y = (width - offset_x - new_width,
+                                  height - offset_y - new_height)
+        elif self.angle == 270:
+            offset_x, offset_y = offset_y, width - offset_x - new_width
+
+        self.x += offset_x / REFERENCE_WIDTH
+        self.y += offset_y / REFERENCE_HEIGHT
+        self.width *= trim_width
+        self.height *= trim_height
+        self.trim = tuple(trim)
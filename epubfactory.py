@@ -12,7 +12,7 @@ from gettext import gettext as _
 from sugar3 import mime
 from sugar3 import profile
 
-from imagecanvas import ImageCanvas
+from pagerenderer import PageRenderer
 
 _title_page_template = """
     <html xmlns="http://www.w3.org/1999/xhtml">
@@ -55,7 +55,7 @@ def create_ebub_from_book_model(title, book_model):
         html_file.write(html)
 
     # create the html with the text and images for every page (800 x 600)
-    image_renderer = ImageCanvas()
+    image_renderer = PageRenderer()
     counter = 1
     html = """<html xmlns="http://www.w3.org/1999/xhtml">
               <head>
@@ -0,0 +1,170 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Measure the time used to draw the frames in the canvas.
+
+Is enabled setting the environment variable WRITEBOOKS_FRAME_STATS
+to 'log', to log the slow frames and a histogram of the frame times,
+or to 'overlay', to also display the times over the canvas."""
+
+import logging
+import os
+import time
+from collections import deque
+
+_MODE = os.environ.get('WRITEBOOKS_FRAME_STATS', '')
+
+# frames taking more than this time are logged, in seconds
+FRAME_BUDGET = 0.016
+# upper limits of the histogram buckets, in ms
+HISTOGRAM_BUCKETS = [4, 8, 16, 33, 66, 133]
+# number of frames used to calculate the histogram
+FRAMES_KEPT = 300
+
+
+def is_enabled():
+    return _MODE in ('log', 'overlay')
+
+
+def is_overlay_enabled():
+    return _MODE == 'overlay'
+
+
+class FrameStats():
+
+    def __init__(self):
+        self._frame_times = deque(maxlen=FRAMES_KEPT)
+        self._frame_start = None
+        self._frames_since_dump = 0
+        # times in the actual frame, in seconds
+        self._decode_time = 0
+        self._source_time = 0
+        self._paint_time = 0
+        self._image_sizes = []
+        self._last_frame = None
+        # images decoded in background threads since the last dump
+        self._async_decodes = 0
+        self._async_decode_time = 0
+        self._interaction_frames = None
+        self._last_interaction_frames = 0
+
+    def start_frame(self):
+        self._frame_start = time.time()
+        self._decode_time = 0
+        self._source_time = 0
+        self._paint_time = 0
+        self._image_sizes = []
+
+    def add_image_times(self, decode_time, source_time, paint_time, size):
+        """
+        Add the times used to draw a image in the actual frame
+        size -- (width, height) of the image in the device
+        """
+        self._decode_time += decode_time
+        self._source_time += source_time
+        self._paint_time += paint_time
+        self._image_sizes.append(size)
+
+    def add_async_decode_time(self, decode_time):
+        self._async_decodes += 1
+        self._async_decode_time += decode_time
+
+    def end_frame(self):
+        frame_time = time.time() - self._frame_start
+        self._frame_times.append(frame_time)
+        self._last_frame = (frame_time, self._decode_time, self._source_time,
+                            self._paint_time)
+        if self._interaction_frames is not None:
+            self._interaction_frames += 1
+
+        if frame_time > FRAME_BUDGET:
+            logging.warning(
+                'Slow frame: %.1f ms (decode %.1f, source %.1f, paint %.1f)'
+                ' drawing %d images, sizes %s', frame_time * 1000,
+                self._decode_time * 1000, self._source_time * 1000,
+                self._paint_time * 1000, len(self._image_sizes),
+                ', '.join('%dx%d' % size for size in self._image_sizes))
+
+        self._frames_since_dump += 1
+        if self._frames_since_dump >= FRAMES_KEPT:
+            self.dump_histogram()
+
+    def start_interaction(self):
+        self._interaction_frames = 0
+
+    def end_interaction(self):
+        if self._interaction_frames is not None:
+            self._last_interaction_frames = self._interaction_frames
+            logging.debug('Frames drawn in the interaction: %d',
+                          self._interaction_frames)
+        self._interaction_frames = None
+
+    def get_histogram(self):
+        """
+        Return a list of tuples (upper limit in ms, number of frames),
+        the last limit is None for the frames slower than all the buckets
+        """
+        counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for frame_time in self._frame_times:
+            frame_ms = frame_time * 1000
+            bucket = 0
+            while bucket < len(HISTOGRAM_BUCKETS) and \
+                    frame_ms > HISTOGRAM_BUCKETS[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+        return zip(HISTOGRAM_BUCKETS + [None], counts)
+
+    def dump_histogram(self):
+        self._frames_since_dump = 0
+        lines = []
+        for limit, count in self.get_histogram():
+            if limit is None:
+                label = '> %d ms' % HISTOGRAM_BUCKETS[-1]
+            else:
+                label = '<= %d ms' % limit
+            lines.append('%s: %d' % (label, count))
+        logging.info('Frame times of the last %d frames: %s',
+                     len(self._frame_times), ', '.join(lines))
+        if self._async_decodes:
+            logging.info('Images decoded in background: %d, %.1f ms',
+                         self._async_decodes, self._async_decode_time * 1000)
+        self._async_decodes = 0
+        self._async_decode_time = 0
+
+    def draw_overlay(self, ctx):
+        if self._last_frame is None:
+            return
+        frame_time, decode_time, source_time, paint_time = self._last_frame
+        average = sum(self._frame_times) / len(self._frame_times)
+        lines = [
+            'frame %.1f ms (avg %.1f ms)' % (frame_time * 1000,
+                                             average * 1000),
+            'decode %.1f source %.1f paint %.1f ms' % (
+                decode_time * 1000, source_time * 1000, paint_time * 1000),
+            'images %d, frames in interaction %d' % (
+                len(self._image_sizes), self._last_interaction_frames)]
+        ctx.save()
+        ctx.set_font_size(12)
+        ctx.rectangle(4, 4, 280, 16 * len(lines) + 8)
+        ctx.set_source_rgba(0, 0, 0, 0.6)
+        ctx.fill()
+        ctx.set_source_rgb(1, 1, 1)
+        y = 20
+        for line in lines:
+            ctx.move_to(10, y)
+            ctx.show_text(line)
+            y += 16
+        ctx.restore()
@@ -14,6 +14,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+from collections import OrderedDict
+
 from gi.repository import GObject
 from gi.repository import Gtk
 
@@ -44,11 +46,20 @@ class IconModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
 
     _PAGE_SIZE = 100
 
+    # the rows are read from the result set in blocks, and the blocks
+    # near the visible rows are kept
+    _BLOCK_SIZE = 50
+    _MAX_BLOCKS = 6
+
     def __init__(self, query):
         GObject.GObject.__init__(self)
 
-        self._last_requested_index = None
-        self._cached_row = None
+        # tuples with the values of the rows, by block number
+        self._blocks = OrderedDict()
+        self._last_block = None
+        # 1 or -1, the direction of the scroll
+        self._direction = 1
+        self._prefetch_id = None
         self._result_set = model.find(query, IconModel._PAGE_SIZE)
         self._temp_drag_file_path = None
 
@@ -69,6 +80,9 @@ class IconModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
         self._result_set.setup()
 
     def stop(self):
+        if self._prefetch_id is not None:
+            GObject.source_remove(self._prefetch_id)
+            self._prefetch_id = None
         self._result_set.stop()
 
     def get_metadata(self, path):
@@ -91,23 +105,61 @@ class IconModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
             return None
 
         index = iterator.user_data
-        if index == self._last_requested_index:
-            return self._cached_row[column]
-
         if index >= self._result_set.length:
             return None
 
-        self._result_set.seek(index)
-        metadata = self._result_set.read()
-
-        self._last_requested_index = index
-        self._cached_row = []
-        self._cached_row.append(metadata['uid'])
-
-        title = GObject.markup_escape_text(metadata.get('title',
-                                           _('Untitled')))
-        self._cached_row.append(title)
-        return self._cached_row[column]
+        block_number = index / IconModel._BLOCK_SIZE
+        block = self._get_block(block_number)
+        if block_number != self._last_block:
+            # read the next block in background, before is displayed
+            if self._last_block is not None:
+                if block_number > self._last_block:
+                    self._direction = 1
+                else:
+                    self._direction = -1
+            self._last_block = block_number
+            self._schedule_prefetch(block_number + self._direction)
+        return block[index - block_number * IconModel._BLOCK_SIZE][column]
+
+    def _get_block(self, block_number):
+        block = self._blocks.pop(block_number, None)
+        if block is None:
+            block = self._read_block(block_number)
+        # keep the blocks used more recently at the end
+        self._blocks[block_number] = block
+        while len(self._blocks) > IconModel._MAX_BLOCKS:
+            self._blocks.popitem(last=False)
+        return block
+
+    def _read_block(self, block_number):
+        start = block_number * IconModel._BLOCK_SIZE
+        end = min(start + IconModel._BLOCK_SIZE, self._result_set.length)
+        block = []
+        for index in range(start, end):
+            self._result_set.seek(index)
+            metadata = self._result_set.read()
+            title = GObject.markup_escape_text(metadata.get('title',
+                                               _('Untitled')))
+            block.append((metadata['uid'], title))
+        return block
+
+    def _schedule_prefetch(self, block_number):
+        if block_number < 0 or block_number in self._blocks or \
+                block_number * IconModel._BLOCK_SIZE >= \
+                self._result_set.length:
+            return
+        if self._prefetch_id is not None:
+            GObject.source_remove(self._prefetch_id)
+        self._prefetch_id = GObject.idle_add(self.__prefetch_cb, block_number,
+                                             priority=GObject.PRIORITY_LOW)
+
+    def __prefetch_cb(self, block_number):
+        self._prefetch_id = None
+        if block_number not in self._blocks:
+            self._blocks[block_number] = self._read_block(block_number)
+            while len(self._blocks) > IconModel._MAX_BLOCKS:
+                self._blocks.popitem(last=False)
+        return False
 
     def do_iter_nth_child(self, parent_iter, n):
         return (False, None)
@@ -28,10 +28,86 @@ from sugar3.graphics import style
 from jarabelocal.journal import model
 
 from iconmodel import IconModel
+from lrucache import LRUCache
+from lrucache import get_available_memory
+from lrucache import get_pixbuf_size
+from pagerenderer import PLACEHOLDER_COLOR
+import thumbnailcache
+from workqueue import WorkQueue
 
 PREVIEW_SIZE = style.zoom(300) / 2, style.zoom(225) / 2
 
-_pixbuf_cache = {}
+# memory used to keep the previews, in bytes
+PREVIEW_CACHE_SIZE = 6 * 1024 * 1024
+# if the memory available in the system is lower than this,
+# the previews cache is reduced to a quarter
+LOW_MEMORY = 16 * 1024 * 1024
+LOW_MEMORY_CACHE_SIZE = PREVIEW_CACHE_SIZE / 4
+
+_pixbuf_cache = LRUCache(PREVIEW_CACHE_SIZE, get_pixbuf_size)
+
+# the previews not cached are decoded in background threads
+_queue = WorkQueue(n_threads=2)
+
+_placeholder = None
+
+
+def set_preview_cache_size(max_bytes):
+    _pixbuf_cache.set_max_bytes(max_bytes)
+
+
+def clear_preview_cache():
+    logging.debug('Previews cache: %d hits, %d misses',
+                  _pixbuf_cache.hits, _pixbuf_cache.misses)
+    _pixbuf_cache.clear()
+
+
+def _cache_pixbuf(preview_path, pixbuf):
+    _pixbuf_cache.put(preview_path, pixbuf)
+    available_memory = get_available_memory()
+    if available_memory is not None and available_memory < LOW_MEMORY:
+        _pixbuf_cache.shrink(LOW_MEMORY_CACHE_SIZE)
+
+
+def _get_placeholder():
+    # displayed while the preview is decoded, or if can't be decoded
+    global _placeholder
+    if _placeholder is None:
+        _placeholder = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False,
+                                            8, PREVIEW_SIZE[0],
+                                            PREVIEW_SIZE[1])
+        red, green, blue = [int(value * 255) for value in PLACEHOLDER_COLOR]
+        _placeholder.fill((red << 24) + (green << 16) + (blue << 8) + 255)
+    return _placeholder
+
+
+def _read_preview_pixbuf(preview_path, width, height):
+    """
+    Return a Pixbuf with the preview, without using the cache,
+    can be called from any thread
+    """
+    # read the small thumbnail, if was already created
+    thumbnail_path = thumbnailcache.lookup(preview_path, width, height)
+    if thumbnail_path is not None:
+        try:
+            return GdkPixbuf.Pixbuf.new_from_file(thumbnail_path)
+        except GLib.GError:
+            logging.exception('Error reading thumbnail %s', thumbnail_path)
+
+    return GdkPixbuf.Pixbuf.new_from_file_at_size(
+        preview_path, width, height)
+
+
+def _load_preview(job, preview_path):
+    # executed in the worker threads
+    if job.cancelled:
+        return None
+    try:
+        return _read_preview_pixbuf(preview_path, PREVIEW_SIZE[0],
+                                    PREVIEW_SIZE[1])
+    except GLib.GError:
+        logging.exception('Error reading preview %s', preview_path)
+        return None
 
 
 def get_preview_pixbuf(preview_path, width=-1, height=-1):
@@ -53,12 +129,12 @@ def get_preview_pixbuf(preview_path, width=-1, height=-1):
     if height == -1:
         height = PREVIEW_SIZE[1]
 
-    if preview_path in _pixbuf_cache:
-        return _pixbuf_cache[preview_path]
+    pixbuf = _pixbuf_cache.get(preview_path)
+    if pixbuf is not None:
+        return pixbuf
 
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-        preview_path, width, height)
-    _pixbuf_cache[preview_path] = pixbuf
+    pixbuf = _read_preview_pixbuf(preview_path, width, height)
+    _cache_pixbuf(preview_path, pixbuf)
     return pixbuf
 
 
@@ -67,18 +143,33 @@ class PreviewRenderer(Gtk.CellRendererPixbuf):
     def __init__(self, **kwds):
         Gtk.CellRendererPixbuf.__init__(self, **kwds)
         self._preview_path = None
+        self._row = None
         self.props.pixbuf = None
 
-    def set_preview_path(self, path):
+    def set_preview_path(self, path, row=None):
+        """
+        path -- the image displayed
+        row -- the number of the row in the model
+        """
         if self._preview_path != path:
             self._preview_path = path
             self.props.pixbuf = None
+        self._row = row
 
     def do_render(self, cr, widget, background_area, cell_area, flags):
+        waiting = False
         if self.props.pixbuf is None:
-            self.props.pixbuf = get_preview_pixbuf(self._preview_path)
+            pixbuf = _pixbuf_cache.get(self._preview_path)
+            if pixbuf is None:
+                # the view draws the cell again when is decoded
+                widget.request_preview(self._preview_path, self._row)
+                pixbuf = _get_placeholder()
+                waiting = True
+            self.props.pixbuf = pixbuf
         Gtk.CellRendererPixbuf.do_render(self, cr, widget, background_area,
                                          cell_area, flags)
+        if waiting:
+            self.props.pixbuf = None
 
     def do_get_size(self, widget, cell_area):
         x_offset, y_offset, width, height = Gtk.CellRendererPixbuf.do_get_size(
@@ -95,15 +186,23 @@ class PreviewIconView(Gtk.IconView):
 
         self._preview_path_col = preview_path_col
         self._title_col = title_col
+        # the jobs decoding the previews, by path
+        self._preview_jobs = {}
+        # the paths of the previews that could not be decoded, not cached
+        # because the file can be being copied, and tried again when
+        # the model is updated
+        self._failed_previews = set()
+        self.connect('destroy', self.__destroy_cb)
+        self.connect('notify::model', self.__model_changed_cb)
 
         self.set_spacing(3)
         self.set_row_spacing(5)
         self.set_column_spacing(3)
 
-        _preview_renderer = PreviewRenderer()
-        _preview_renderer.set_alignment(0.5, 0.5)
-        self.pack_start(_preview_renderer, False)
-        self.set_cell_data_func(_preview_renderer,
+        self._preview_renderer = PreviewRenderer()
+        self._preview_renderer.set_alignment(0.5, 0.5)
+        self.pack_start(self._preview_renderer, False)
+        self.set_cell_data_func(self._preview_renderer,
                                 self._preview_data_func, None)
 
         _title_renderer = Gtk.CellRendererText()
@@ -114,7 +213,64 @@ class PreviewIconView(Gtk.IconView):
 
     def _preview_data_func(self, view, cell, store, i, data):
         preview_path = store.get_value(i, self._preview_path_col)
-        cell.set_preview_path(preview_path)
+        cell.set_preview_path(preview_path, store.get_path(i).get_indices()[0])
+
+    def request_preview(self, preview_path, row):
+        """Decode the preview in background, and draw the row when ready"""
+        if preview_path in self._failed_previews:
+            # the placeholder is displayed
+            return
+        job = self._preview_jobs.get(preview_path)
+        if job is not None:
+            job.row = row
+            return
+        job = _queue.add(_load_preview, (preview_path,),
+                         self.__preview_loaded_cb)
+        job.preview_path = preview_path
+        job.row = row
+        self._preview_jobs[preview_path] = job
+
+    def __preview_loaded_cb(self, job, pixbuf):
+        if self._preview_jobs.get(job.preview_path) is not job:
+            return
+        del self._preview_jobs[job.preview_path]
+        if pixbuf is None:
+            # don't try again to decode the file with this model
+            self._failed_previews.add(job.preview_path)
+        else:
+            _cache_pixbuf(job.preview_path, pixbuf)
+        if job.row is None:
+            self.queue_draw()
+            return
+        # draw only the cell of the preview
+        success, rect = self.get_cell_rect(Gtk.TreePath(job.row),
+                                           self._preview_renderer)
+        if success:
+            self.queue_draw_area(rect.x, rect.y, rect.width, rect.height)
+
+    def drop_hidden_previews(self):
+        """Cancel the decoding of the previews of the rows not visible"""
+        visible_range = self.get_visible_range()
+        if not visible_range or not visible_range[0]:
+            self.cancel_previews()
+            return
+        first = visible_range[1][0]
+        last = visible_range[2][0]
+        for preview_path, job in self._preview_jobs.items():
+            if job.row is not None and not first <= job.row <= last:
+                job.cancel()
+                del self._preview_jobs[preview_path]
+
+    def cancel_previews(self):
+        for job in self._preview_jobs.values():
+            job.cancel()
+        self._preview_jobs = {}
+
+    def __destroy_cb(self, widget):
+        self.cancel_previews()
+
+    def __model_changed_cb(self, widget, pspec):
+        self._failed_previews = set()
 
     def _title_data_func(self, view, cell, store, i, data):
         title = store.get_value(i, self._title_col)
@@ -161,6 +317,8 @@ class IconView(Gtk.Bin):
 
         self._scrolled_window.add(self.icon_view)
         self.icon_view.show()
+        self.icon_view.props.vadjustment.connect('value-changed',
+                                                 self.__scrolled_cb)
 
         # Auto-update stuff
         self._fully_obscured = True
@@ -171,6 +329,10 @@ class IconView(Gtk.Bin):
         model.updated.connect(self.__model_updated_cb)
         model.deleted.connect(self.__model_deleted_cb)
 
+    def __scrolled_cb(self, adjustment):
+        # the previews of the rows scrolled away are not decoded
+        self.icon_view.drop_hidden_previews()
+
     def __button_release_event_cb(self, icon_view, event):
         path = icon_view.get_path_at_pos(int(event.x), int(event.y))
         if path is None:
@@ -201,6 +363,10 @@ class IconView(Gtk.Bin):
 
     def _is_new_item_visible(self, object_id):
         """Check if the created item is part of the currently selected view"""
+        if 'catalog' in self._query:
+            catalog = self._query['catalog']
+            return catalog.get_category(object_id) in \
+                self._query['categories']
         if self._query['mountpoints'] == ['/']:
             return not object_id.startswith('/')
         else:
@@ -240,6 +406,7 @@ class IconView(Gtk.Bin):
 
         # Cannot set it up earlier because will try to access the model
         # and it needs to be ready.
+        self.icon_view.cancel_previews()
         self.icon_view.set_model(self._model)
 
         self.icon_view.props.vadjustment.props.value = self._scroll_position
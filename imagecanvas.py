@@ -2,7 +2,7 @@
 #
 import cairo
 import logging
-import math
+import sys
 
 from gi.repository import GObject
 from gi.repository import Gtk
@@ -10,9 +10,26 @@ from gi.repository import Gdk
 from gi.repository import GdkPixbuf
 from sugar3.graphics import style
 
+import framestats
+import imageloader
+from pagerenderer import draw_background
+from pagerenderer import draw_border
+from pagerenderer import draw_image
+
 WIDTH_CONTROL_LINES = 2
 CONTROL_SIZE = style.GRID_CELL_SIZE / 2
 
+# size of the cells in the grid used to find the images under a point
+INDEX_CELL_SIZE = style.GRID_CELL_SIZE * 2
+# max size of the downsampled alpha mask used to check clicks over images
+ALPHA_MASK_SIZE = 64
+# alpha values lower than this are considered transparent
+ALPHA_THRESHOLD = 16
+# position of the alpha byte in the ARGB32 pixels, stored in native endian
+ALPHA_OFFSET = 3 if sys.byteorder == 'little' else 0
+# time without input before drawing again with the best quality, in ms
+REFINE_DELAY = 150
+
 
 class ImageCanvas(Gtk.DrawingArea):
 
@@ -29,14 +46,33 @@ class ImageCanvas(Gtk.DrawingArea):
             Gdk.EventMask.BUTTON_RELEASE_MASK |
             Gdk.EventMask.BUTTON_MOTION_MASK)
 
+        self._width = 0
+        self._height = 0
         self._background = None
         self._background_path = None
+        self._background_job = None
+        # the canvas size used to decode the background
+        self._background_size = None
+        self._background_outdated = False
+        # the canvas size when the background could not be decoded,
+        # to not try again until the background or the size change
+        self._background_failed_size = None
         self._image_models = []
         self._images = []
+        self._image_jobs = []
         self._active_image = None
         self._press_on_image = False
         self._press_on_resize = False
+        # while the user is moving or resizing images, the frames are
+        # drawn with less quality, and refined when the input stops
+        self._interacting = False
+        self._refine_timeout_id = None
         self._modified = False
+        self._index = _SpatialIndex(INDEX_CELL_SIZE)
+        self._index_dirty = True
+        self._frame_stats = None
+        if framestats.is_enabled():
+            self._frame_stats = framestats.FrameStats()
 
         self.connect('size_allocate', self.__size_allocate_cb)
         self.connect("draw", self.__draw_cb)
@@ -48,15 +84,14 @@ class ImageCanvas(Gtk.DrawingArea):
         self._bt_release_id = self.connect(
             'button_release_event', self.__button_release_cb)
 
-        # load pixbufs for controls
-        self._rotate_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            './icons/object_rotate_right.svg', CONTROL_SIZE, CONTROL_SIZE)
-        self._mirror_h_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            './icons/mirror-horizontal.svg', CONTROL_SIZE, CONTROL_SIZE)
-        self._mirror_v_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            './icons/mirror-vertical.svg', CONTROL_SIZE, CONTROL_SIZE)
-        self._resize_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            './icons/resize.svg', CONTROL_SIZE, CONTROL_SIZE)
+        # load surfaces for controls
+        self._rotate_surface = _load_control_surface(
+            './icons/object_rotate_right.svg')
+        self._mirror_h_surface = _load_control_surface(
+            './icons/mirror-horizontal.svg')
+        self._mirror_v_surface = _load_control_surface(
+            './icons/mirror-vertical.svg')
+        self._resize_surface = _load_control_surface('./icons/resize.svg')
 
     def __size_allocate_cb(self, widget, allocation):
         logging.debug('allocation called in the canvas %s x %s',
@@ -64,10 +99,22 @@ class ImageCanvas(Gtk.DrawingArea):
         width, height = allocation.width, allocation.height
         if allocation.width == 1 and allocation.height == 1:
             return
+        if (width, height) == (self._width, self._height):
+            return
         self._width = width
         self._height = height
-        self._background = None
-        self._create_view_images()
+        # the positions and sizes are stored as percentages, then only
+        # the canvas size is updated in the views, without decoding again
+        for image_view in self._images:
+            image_view.set_canvas_size(width, height)
+        self._index_dirty = True
+        # the background already decoded is scaled while drawing,
+        # and decoded again only if the canvas is bigger
+        if self._background_size is None or \
+                width > self._background_size[0] or \
+                height > self._background_size[1]:
+            self._cancel_background_job()
+            self._background_outdated = True
 
     def set_editable(self, editable):
         if not editable:
@@ -84,8 +131,48 @@ class ImageCanvas(Gtk.DrawingArea):
                 'button_release_event', self.__button_release_cb)
 
     def set_background(self, file_path):
+        self._cancel_background_job()
         self._background_path = file_path
         self._background = None
+        self._background_size = None
+        self._background_outdated = False
+        self._background_failed_size = None
+        self.queue_draw()
+
+    def _cancel_background_job(self):
+        if self._background_job is not None:
+            self._background_job.cancel()
+            self._background_job = None
+
+    def _load_background(self):
+        if self._background_failed_size == (self._width, self._height):
+            return
+        # while the new size is decoded, the old background is used
+        background = imageloader.get_cached(
+            self._background_path, self._width, self._height)
+        if background is not None:
+            self._set_background_surface(background,
+                                         (self._width, self._height))
+        elif self._background_job is None:
+            self._background_job = imageloader.load_async(
+                self._background_path, self._width, self._height,
+                self.__background_loaded_cb)
+            self._background_job.size = (self._width, self._height)
+
+    def _set_background_surface(self, surface, size):
+        self._background = surface
+        self._background_size = size
+        self._background_outdated = False
+
+    def __background_loaded_cb(self, request, surface):
+        self._background_job = None
+        if surface is None:
+            # the placeholder or the old background are drawn
+            logging.error('Error loading the background %s',
+                          self._background_path)
+            self._background_failed_size = request.size
+        else:
+            self._set_background_surface(surface, request.size)
         self.queue_draw()
 
     def set_images(self, image_models):
@@ -95,6 +182,10 @@ class ImageCanvas(Gtk.DrawingArea):
         self.queue_draw()
 
     def _create_view_images(self):
+        for job in self._image_jobs:
+            job.cancel()
+        self._image_jobs = []
+        self._cancel_scaled_requests()
         self._images = []
         for image_model in self._image_models:
             image_view = ImageView(
@@ -105,111 +196,133 @@ class ImageCanvas(Gtk.DrawingArea):
             image_view.h_mirrored = image_model.h_mirrored
             image_view.v_mirrored = image_model.v_mirrored
             image_view.angle = image_model.angle
+            image_view.trim = image_model.trim
+            image_view.model = image_model
+            image = imageloader.get_cached(image_view.path)
+            if image is not None:
+                image_view.set_image(image)
+            else:
+                self._image_jobs.append(imageloader.load_async(
+                    image_view.path, -1, -1, self.__image_loaded_cb))
+                image_view.load_request = self._image_jobs[-1]
             self._images.append(image_view)
+        self._index_dirty = True
+
+    def update_trim(self, image_model):
+        """
+        Update the view of a image trimmed after was displayed,
+        without decoding it again
+        """
+        for image_view in self._images:
+            if image_view.model is not image_model:
+                continue
+            image_view.x = image_model.x
+            image_view.y = image_model.y
+            image_view.width = image_model.width
+            image_view.height = image_model.height
+            image_view.trim = image_model.trim
+            # if the size was not defined, is set from the trimmed size
+            image_view.set_canvas_size(self._width, self._height)
+            self._index_dirty = True
+            self.queue_draw()
+
+    def prefetch(self, background_path, image_models):
+        """
+        Decode in the background the images needed to show a page,
+        with the actual canvas size, to be able to display it quickly.
+        Return a list with the LoadRequest objects,
+        can be used to cancel the prefetch.
+        """
+        requests = []
+        if self._width == 0:
+            return requests
+        if background_path is not None:
+            requests.append(imageloader.prefetch(
+                background_path, self._width, self._height))
+        for image_model in image_models:
+            requests.append(imageloader.prefetch(image_model.path))
+        return [request for request in requests if request is not None]
+
+    def __image_loaded_cb(self, request, image):
+        self._image_jobs.remove(request)
+        if self._frame_stats is not None:
+            self._frame_stats.add_async_decode_time(request.get_decode_time())
+        for image_view in self._images:
+            if image_view.load_request is request:
+                image_view.load_request = None
+                image_view.set_image(image)
+        # the size can change if was not defined in the model
+        self._index_dirty = True
+        self.queue_draw()
+
+    def _update_index(self):
+        # the bounds are expanded to include the corner controls
+        half_ctrl_size = CONTROL_SIZE / 2
+        self._index.clear()
+        for image_view in self._images:
+            x, y, width, height = image_view.get_bounds()
+            self._index.insert(image_view, x - half_ctrl_size,
+                               y - half_ctrl_size, width + CONTROL_SIZE,
+                               height + CONTROL_SIZE)
+        self._index_dirty = False
 
     def __draw_cb(self, widget, context):
+        if self._frame_stats is None:
+            self.draw_in_context(context)
+            return False
+        self._frame_stats.start_frame()
         self.draw_in_context(context)
+        self._frame_stats.end_frame()
+        if framestats.is_overlay_enabled():
+            self._frame_stats.draw_overlay(context)
         return False
 
-    def create_pixbuf(self, width, height, background_path, images):
-        # this method is here to not need copy all the logic
-        # to draw the iconview icons in the sorting screen
-        # do not use the same widget as is used to edit in different sizes
-        # or the cached pixbuf will be broken
-        self._width = width
-        self._height = height
-        self.set_background(background_path)
-        self.set_images(images)
-        surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, self._width, self._height)
-        ctx = cairo.Context(surface)
-        self.draw_in_context(ctx)
-        surface.flush()
-        return Gdk.pixbuf_get_from_surface(surface, 0, 0,
-                                           self._width, self._height)
-
     def create_pixbuf_with_active_image(self):
-        if not self.is_image_active():
+        if not self.is_image_active() or self._active_image.image is None:
             return None
-        image_view = self._active_image
-        width, height = image_view.get_size()
-        surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, self._width, self._height)
-        ctx = cairo.Context(surface)
-        Gdk.cairo_set_source_pixbuf(ctx, image_view.pixbuf, 0, 0)
-        ctx.paint()
-        surface.flush()
-        return Gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
-
-    def write_to_png(self, dest_path, width, height, background_path, images):
-        # this method is here to not need copy all the logic
-        # to draw the image to use in the epub files
-        # do not use the same widget as is used to edit in different sizes
-        # or the cached pixbuf will be broken
-        self._width = width
-        self._height = height
-        self.set_background(background_path)
-        self.set_images(images)
-        surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, self._width, self._height)
-        ctx = cairo.Context(surface)
-        self.draw_in_context(ctx)
-        surface.flush()
-        surface.write_to_png(dest_path)
+        # the clipboard needs a pixbuf, this is the only place where
+        # the surfaces are converted back
+        surface = imageloader.get_image_surface(self._active_image.image)
+        return Gdk.pixbuf_get_from_surface(
+            surface, 0, 0, surface.get_width(), surface.get_height())
 
     def draw_in_context(self, ctx):
         # Draw the background image
 
-        if self._background is None and self._background_path is not None:
-            self._background = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                self._background_path, self._width, self._height)
+        if self._background_path is not None and \
+                (self._background is None or self._background_outdated):
+            self._load_background()
 
-        if self._background_path is None:
-            # draw a white background
-            ctx.rectangle(0, 0, self._width, self._height)
-            ctx.set_source_rgb(1, 1, 1)
-            ctx.fill()
+        if self._background is None:
+            draw_background(ctx, self._width, self._height,
+                            self._background_path, None)
         else:
-            Gdk.cairo_set_source_pixbuf(ctx, self._background, 0, 0)
-            ctx.paint()
+            # the background can be decoded for other canvas size
+            background_width, background_height = self._background_size
+            ctx.save()
+            ctx.scale(float(self._width) / background_width,
+                      float(self._height) / background_height)
+            draw_background(ctx, background_width, background_height,
+                            self._background_path, self._background)
+            ctx.restore()
+
+        # during the interaction, use a fast filter and the svg images
+        # already rendered, instead of rendering them at the new size
+        cairo_filter = None
+        if self._interacting:
+            cairo_filter = cairo.FILTER_FAST
 
         for image_view in self._images:
             x_ini, y_ini = image_view.get_coordinates()
             width, height = image_view.get_size()
-            ctx.save()
-            ctx.translate(x_ini, y_ini)
-
-            if image_view.angle != 0:
-                radians_angle = math.pi * float(image_view.angle) / 180.0
-                ctx.rotate(radians_angle)
-                if image_view.angle == 90:
-                    ctx.translate(0, -height)
-                elif image_view.angle == 180:
-                    ctx.translate(-width, -height)
-                elif image_view.angle == 270:
-                    ctx.translate(-width, 0)
-
-            h_mirrored = image_view.h_mirrored
-            v_mirrored = image_view.v_mirrored
-            if image_view.angle == 90 or image_view.angle == 270:
-                h_mirrored, v_mirrored = v_mirrored, h_mirrored
-
-            if h_mirrored:
-                ctx.translate(width, 0)
-                ctx.scale(-1.0, 1.0)
-            if v_mirrored:
-                ctx.translate(0, height)
-                ctx.scale(1.0, -1.0)
-
-            scale_x = width / image_view.pixbuf.get_width() * 1.0
-            scale_y = height / image_view.pixbuf.get_height() * 1.0
-            ctx.scale(scale_x, scale_y)
-            Gdk.cairo_set_source_pixbuf(ctx, image_view.pixbuf, 0, 0)
-            if self._press_on_resize:
-                ctx.get_source().set_filter(cairo.FILTER_NEAREST)
-
-            ctx.paint()
-            ctx.restore()
+            image = image_view.image
+            if self._interacting and image is not None:
+                image = self._get_interaction_image(image_view, width,
+                                                    height)
+            draw_image(ctx, image, x_ini, y_ini, width, height,
+                       image_view.angle, image_view.h_mirrored,
+                       image_view.v_mirrored, cairo_filter,
+                       self._frame_stats, image_view.trim)
             if image_view == self._active_image:
                 if image_view.angle == 90 or image_view.angle == 270:
                     width, height = height, width
@@ -226,40 +339,84 @@ class ImageCanvas(Gtk.DrawingArea):
                 ctx.stroke()
                 # draw the rotate corner
                 self._draw_control(ctx, -CONTROL_SIZE / 2, -CONTROL_SIZE / 2,
-                                   self._rotate_pixbuf)
+                                   self._rotate_surface)
                 # draw the horizontal mirror
                 self._draw_control(ctx, width - CONTROL_SIZE / 2,
                                    -CONTROL_SIZE / 2,
-                                   self._mirror_h_pixbuf)
+                                   self._mirror_h_surface)
                 self._draw_control(ctx, -CONTROL_SIZE / 2,
                                    height - CONTROL_SIZE / 2,
-                                   self._mirror_v_pixbuf)
+                                   self._mirror_v_surface)
                 self._draw_control(ctx, width - CONTROL_SIZE / 2,
                                    height - CONTROL_SIZE / 2,
-                                   self._resize_pixbuf)
+                                   self._resize_surface)
                 ctx.restore()
 
-        # Draw the border
-        ctx.save()
-        ctx.set_line_width(2)
-        ctx.rectangle(0, 0, self._width, self._height)
-        ctx.set_source_rgb(0, 0, 0)
-        ctx.stroke()
-        ctx.restore()
+        draw_border(ctx, self._width, self._height)
+
+    def _get_interaction_image(self, image_view, width, height):
+        """
+        Return a reduced version of the image, big enough to paint it
+        at width x height, or the image if was not decoded yet, and then
+        is requested to the worker
+        """
+        image = image_view.image
+        if isinstance(image, imageloader.SvgImage):
+            # the svg images use a size already rendered
+            return image
+        trim_width, trim_height = image_view.get_trim_size()
+        width, height = width / trim_width, height / trim_height
+        scaled_image = imageloader.get_cached_scaled(
+            image_view.path, image.get_width(), image.get_height(),
+            width, height)
+        if scaled_image is not None:
+            return scaled_image
+        if image_view.scaled_request is None:
+            image_view.scaled_request = imageloader.load_scaled_async(
+                image_view.path, image.get_width(), image.get_height(),
+                width, height, self.__scaled_image_loaded_cb)
+        return image
+
+    def __scaled_image_loaded_cb(self, request, image):
+        if image is None:
+            # the request is kept, to not try again until the next
+            # interaction
+            return
+        for image_view in self._images:
+            if image_view.scaled_request is request:
+                image_view.scaled_request = None
+        if self._interacting:
+            self.queue_draw()
+
+    def _cancel_scaled_requests(self):
+        for image_view in self._images:
+            if image_view.scaled_request is not None:
+                image_view.scaled_request.cancel()
+                image_view.scaled_request = None
 
-    def _draw_control(self, ctx, x, y, pixbuf):
+    def _draw_control(self, ctx, x, y, surface):
         ctx.save()
         ctx.translate(x, y)
         ctx.rectangle(0, 0, CONTROL_SIZE, CONTROL_SIZE)
         ctx.set_source_rgb(0, 0, 0)
         ctx.fill()
-        Gdk.cairo_set_source_pixbuf(ctx, pixbuf, 0, 0)
+        ctx.set_source_surface(surface, 0, 0)
         ctx.paint()
         ctx.restore()
 
     def __button_press_cb(self, widget, event):
-        # Check if clicked over a image
-        for image_view in self._images:
+        if self._frame_stats is not None:
+            self._frame_stats.start_interaction()
+        # Check if clicked over a image, the topmost first
+        if self._index_dirty:
+            self._update_index()
+        candidates = self._index.query(event.x, event.y)
+        if self._active_image in candidates:
+            # the controls of the active image are drawn over the others
+            candidates.remove(self._active_image)
+            candidates.append(self._active_image)
+
+        for image_view in reversed(candidates):
             in_image = False
 
             if image_view.is_in_size_area(event.x, event.y):
@@ -279,6 +436,8 @@ class ImageCanvas(Gtk.DrawingArea):
                 if image_view.angle < 0:
                     image_view.angle = 270
                 logging.error('Image angle %s', image_view.angle)
+                # the width and height of the bounds are swapped
+                self._index_dirty = True
                 self._modified = True
             elif image_view.is_inside(event.x, event.y):
                 in_image = True
@@ -286,6 +445,8 @@ class ImageCanvas(Gtk.DrawingArea):
 
             if in_image:
                 self._active_image = image_view
+                if self._press_on_image or self._press_on_resize:
+                    self._start_interaction()
                 self.queue_draw()
                 return
 
@@ -293,18 +454,45 @@ class ImageCanvas(Gtk.DrawingArea):
         self._press_on_image = False
         self.queue_draw()
 
+    def _start_interaction(self):
+        self._interacting = True
+        self._schedule_refine()
+
+    def _schedule_refine(self):
+        # the refine is delayed every time a new input is received
+        if self._refine_timeout_id is not None:
+            GObject.source_remove(self._refine_timeout_id)
+        self._refine_timeout_id = GObject.timeout_add(REFINE_DELAY,
+                                                      self.__refine_cb)
+
+    def __refine_cb(self):
+        self._refine_timeout_id = None
+        if self._press_on_image or self._press_on_resize:
+            # the button is still pressed, wait for the release
+            return False
+        self._interacting = False
+        # the reduced images not decoded yet are not needed now
+        self._cancel_scaled_requests()
+        self.queue_draw()
+        return False
+
     def is_image_active(self):
         return self._active_image is not None
 
     def remove_active_image(self):
         if self._active_image is not None:
             self._images.remove(self._active_image)
+            self._index_dirty = True
             self.emit('images-modified', self._images)
             self.queue_draw()
 
     def __button_release_cb(self, widget, event):
+        if self._frame_stats is not None:
+            self._frame_stats.end_interaction()
         self._press_on_image = False
         self._press_on_resize = False
+        if self._interacting:
+            self._schedule_refine()
         self.queue_draw()
         if self._modified:
             self.emit('images-modified', self._images)
@@ -314,13 +502,96 @@ class ImageCanvas(Gtk.DrawingArea):
         if self._press_on_image:
             self._active_image.move(event.x, event.y)
             self._modified = True
+            self._index_dirty = True
+            self._start_interaction()
             self.queue_draw()
         if self._press_on_resize:
             self._active_image.resize(event.x, event.y)
             self._modified = True
+            self._index_dirty = True
+            self._start_interaction()
             self.queue_draw()
 
 
+class _SpatialIndex():
+    """
+    Uniform grid over the bounds of the images, used to find the images
+    under a point without testing all of them.
+    The items in every cell are kept in the order they were inserted,
+    then the last item is the topmost.
+    """
+
+    def __init__(self, cell_size):
+        self._cell_size = cell_size
+        self._cells = {}
+
+    def clear(self):
+        self._cells = {}
+
+    def insert(self, item, x, y, width, height):
+        col_ini = int(x // self._cell_size)
+        col_end = int((x + width) // self._cell_size)
+        row_ini = int(y // self._cell_size)
+        row_end = int((y + height) // self._cell_size)
+        for col in range(col_ini, col_end + 1):
+            for row in range(row_ini, row_end + 1):
+                self._cells.setdefault((col, row), []).append(item)
+
+    def query(self, x, y):
+        """
+        Return a list with the items with bounds over the cell
+        containing the point, from the bottom to the top
+        """
+        cell = (int(x // self._cell_size), int(y // self._cell_size))
+        return self._cells.get(cell, [])[:]
+
+
+def _load_control_surface(path):
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(path, CONTROL_SIZE,
+                                                    CONTROL_SIZE)
+    return imageloader.pixbuf_to_surface(pixbuf)
+
+
+def _create_alpha_mask(image):
+    """
+    Return a tuple (width, height, mask) where mask is a bytearray with
+    a downsampled version of the image alpha channel, with 1 where the
+    image is opaque and 0 where it is transparent.
+    Return None if the image does not have alpha channel.
+    """
+    width, height = image.get_width(), image.get_height()
+    scale = min(1., float(ALPHA_MASK_SIZE) / max(width, height))
+    mask_width = max(1, int(width * scale))
+    mask_height = max(1, int(height * scale))
+    # the svg images are rendered directly at the size of the mask,
+    # without keeping it with the sizes displayed
+    if isinstance(image, imageloader.SvgImage):
+        surface = image.render(mask_width, mask_height)
+    else:
+        surface = image
+    if surface.get_format() != cairo.FORMAT_ARGB32:
+        return None
+    width, height = surface.get_width(), surface.get_height()
+    if (width, height) != (mask_width, mask_height):
+        small_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, mask_width,
+                                           mask_height)
+        ctx = cairo.Context(small_surface)
+        ctx.scale(float(mask_width) / width, float(mask_height) / height)
+        ctx.set_source_surface(surface, 0, 0)
+        ctx.paint()
+        small_surface.flush()
+        surface = small_surface
+    pixels = bytearray(surface.get_data())
+    stride = surface.get_stride()
+    mask = bytearray(mask_width * mask_height)
+    for row in range(mask_height):
+        alpha_pos = row * stride + ALPHA_OFFSET
+        for col in range(mask_width):
+            if pixels[alpha_pos + col * 4] > ALPHA_THRESHOLD:
+                mask[row * mask_width + col] = 1
+    return mask_width, mask_height, mask
+
+
 class ImageView():
 
     def __init__(self, path, width, height, canvas_width, canvas_height):
@@ -330,18 +601,22 @@ class ImageView():
         # the size is stored as a percentage of the background image
         self.x = 0
         self.y = 0
-        self.pixbuf = GdkPixbuf.Pixbuf.new_from_file(self.path)
-
+        # the image (a ImageSurface or a SvgImage) is set when is decoded
+        self.image = None
+        self.load_request = None
+        # the bookmodel.Image displayed
+        self.model = None
+        # the request decoding a reduced version, used while interacting
+        self.scaled_request = None
+        self._alpha_mask = None
         self.width = width
-        if width == 0:
-            self.width = self.pixbuf.get_width() * 100. / self._canvas_width
         self.height = height
-        if height == 0:
-            self.height = self.pixbuf.get_height() * 100. / self._canvas_height
 
         self.h_mirrored = False
         self.v_mirrored = False
         self.angle = 0
+        # the part of the image drawn, as in bookmodel.Image
+        self.trim = None
         # points to the start of the image where the user click
         self._dx_click = 0
         self._dy_click = 0
@@ -349,6 +624,38 @@ class ImageView():
         self._resize_from_x, self._resize_from_y = 0, 0
         self._resize_width, self._resize_heigth = 0, 0
 
+    def set_image(self, image):
+        if image is None:
+            return
+        self.image = image
+        self._alpha_mask = _create_alpha_mask(self.image)
+        self._set_default_size()
+
+    def set_canvas_size(self, canvas_width, canvas_height):
+        self._canvas_width = canvas_width
+        self._canvas_height = canvas_height
+        self._set_default_size()
+
+    def _set_default_size(self):
+        # if the size was not defined, use the image size
+        if self.image is None or self._canvas_width == 0:
+            return
+        trim_width, trim_height = self.get_trim_size()
+        if self.width == 0:
+            self.width = self.image.get_width() * trim_width * 100. / \
+                self._canvas_width
+        if self.height == 0:
+            self.height = self.image.get_height() * trim_height * 100. / \
+                self._canvas_height
+
+    def get_trim_size(self):
+        """
+        Return the size of the part of the image drawn, as fractions
+        """
+        if self.trim is None:
+            return 1., 1.
+        return self.trim[2], self.trim[3]
+
     def get_coordinates(self):
         """
         Return coordinates in points
@@ -363,6 +670,17 @@ class ImageView():
         return (self._canvas_width * self.width / 100.,
                 self._canvas_height * self.height / 100.)
 
+    def get_bounds(self):
+        """
+        Return the box (x, y, width, height) in points occupied by the
+        image in the canvas, taking in account the rotation
+        """
+        x_ini, y_ini = self.get_coordinates()
+        width, height = self.get_size()
+        if self.angle == 90 or self.angle == 270:
+            width, height = height, width
+        return x_ini, y_ini, width, height
+
     def is_in_size_area(self, x, y):
         if self._check_point_in_corner_control(x, y, 'BR'):
             self._resize_from_x, self._resize_from_y = x, y
@@ -386,10 +704,7 @@ class ImageView():
             (Top Left, Top Right, Bottom Left and Bottom Right)
         """
         half_ctrl_size = CONTROL_SIZE / 2
-        x_ini, y_ini = self.get_coordinates()
-        width, height = self.get_size()
-        if self.angle == 90 or self.angle == 270:
-            width, height = height, width
+        x_ini, y_ini, width, height = self.get_bounds()
 
         if corner == 'TL':
             x_btn = x_ini
@@ -411,12 +726,10 @@ class ImageView():
             and y_btn - half_ctrl_size < y < y_btn + half_ctrl_size
 
     def is_inside(self, x, y):
-        x_ini, y_ini = self.get_coordinates()
-        width, height = self.get_size()
-        if self.angle == 90 or self.angle == 270:
-            width, height = height, width
+        x_ini, y_ini, width, height = self.get_bounds()
 
-        if x_ini < x < x_ini + width and y_ini < y < y_ini + height:
+        if x_ini < x < x_ini + width and y_ini < y < y_ini + height and \
+                self._is_opaque_at(x - x_ini, y - y_ini):
             self._dx_click = x - x_ini
             self._dy_click = y - y_ini
             return True
@@ -425,6 +738,46 @@ class ImageView():
             self._dy_click = 0
             return False
 
+    def _is_opaque_at(self, dx, dy):
+        """
+        dx, dy -- (float) coordinates in points, relative to the start
+            of the image box
+        Return True if the image is not transparent in that point
+        """
+        if self._alpha_mask is None:
+            return True
+        width, height = self.get_size()
+        # revert the rotation done when the image is drawn
+        if self.angle == 90:
+            u, v = dy, height - dx
+        elif self.angle == 180:
+            u, v = width - dx, height - dy
+        elif self.angle == 270:
+            u, v = width - dy, dx
+        else:
+            u, v = dx, dy
+
+        h_mirrored = self.h_mirrored
+        v_mirrored = self.v_mirrored
+        if self.angle == 90 or self.angle == 270:
+            h_mirrored, v_mirrored = v_mirrored, h_mirrored
+        if h_mirrored:
+            u = width - u
+        if v_mirrored:
+            v = height - v
+
+        # the mask is created from the whole image
+        u, v = u / width, v / height
+        if self.trim is not None:
+            trim_x, trim_y, trim_width, trim_height = self.trim
+            u = trim_x + u * trim_width
+            v = trim_y + v * trim_height
+
+        mask_width, mask_height, mask = self._alpha_mask
+        col = min(mask_width - 1, max(0, int(u * mask_width)))
+        row = min(mask_height - 1, max(0, int(v * mask_height)))
+        return mask[row * mask_width + col] == 1
+
     def move(self, x, y):
         x_new, y_new = x - self._dx_click, y - self._dy_click
         # set as percentage
@@ -33,6 +33,10 @@ from sugar3 import profile
 from sugar3.activity import activity
 
 from iconview import IconView
+from iconview import PREVIEW_SIZE
+from iconview import clear_preview_cache
+import mediacatalog
+import thumbnailcache
 
 _AUTOSEARCH_TIMEOUT = 1000
 
@@ -72,6 +76,7 @@ class ImageFileChooser(Gtk.Window):
         self.connect('visibility-notify-event',
                      self.__visibility_notify_event_cb)
         self.connect('delete-event', self.__delete_event_cb)
+        self.connect('destroy', self.__destroy_cb)
         self.connect('key-press-event', self.__key_press_event_cb)
 
         if parent is None:
@@ -101,12 +106,23 @@ class ImageFileChooser(Gtk.Window):
 
         self._main_path = os.path.join(activity.get_activity_root(), 'data',
                                        image_type)
-        if not os.path.exists(self._main_path):
+        # with categories, the files are read from the original directories
+        if categories is None and not os.path.exists(self._main_path):
             os.makedirs(self._main_path)
 
         self._image_type = image_type
 
-        self._toolbar = SearchToolbox(self._main_path, add_back_button=True)
+        # the media files of the categories are listed from a catalog,
+        # updated only with the directories modified
+        self._catalog = None
+        if categories is not None:
+            self._catalog = mediacatalog.get_catalog(translations)
+            for category, category_paths in categories.items():
+                self._catalog.add_category(category, category_paths)
+
+        self._toolbar = SearchToolbox(self._main_path, add_back_button=True,
+                                      catalog=self._catalog,
+                                      categories=categories)
         self._toolbar.connect('query-changed', self.__query_changed_cb)
         self._toolbar.connect('go-back', self.__go_back_cb)
         self._toolbar.set_size_request(-1, style.GRID_CELL_SIZE)
@@ -145,55 +161,19 @@ class ImageFileChooser(Gtk.Window):
         self._vbox.pack_start(self._buttons_vbox, True, True, 0)
 
     def __category_btn_clicked_cb(self, button, category):
-        category_paths = self._categories[category]
-        # category_paths is a array, but we only can show a single
-        # directory using the datastore backend.
-        # we also want be able to show and search by translated names
-        # the solution is create a cached directory with symlinks to
-        # the media found in the category_paths. If a dictionary data file
-        # is found, the filenames for the links will be translated.
-
-        if len(category_paths) == 1 and self._translations is None:
-            # if is only one directory and there are not translations
-            # we don't need create the directory with the links
-            origin = category_paths[0]
-            category = origin[origin.rfind('/') + 1:]
-            category_directory = os.path.join(self._main_path, category)
-            if not os.path.exists(category_directory):
-                os.symlink(origin, category_directory)
-        else:
-            if self._translations is None:
-                category_directory = os.path.join(self._main_path, category)
-            else:
-                category_directory = os.path.join(
-                    self._main_path, "%s_%s" % (category, self._language))
-            logging.debug('category_directory %s', category_directory)
-            if not os.path.exists(category_directory):
-                os.makedirs(category_directory)
-                # create links for the media files
-                for category_path in category_paths:
-                    for root, dirs, files in os.walk(category_path):
-                        for name in files:
-                            extension = name[name.rfind('.') + 1:].lower()
-                            if extension not in ['jpg', 'png', 'svg', 'gif']:
-                                continue
-                            origin = os.path.join(root, name)
-                            if self._translations is not None and \
-                                    name in self._translations:
-                                destination = os.path.join(
-                                    category_directory,
-                                    self._translations[name])
-                            else:
-                                destination = os.path.join(category_directory,
-                                                           name)
-                            if not os.path.exists(destination):
-                                os.symlink(origin, destination)
-
-        self.show_icon_view(category_directory)
-
-    def show_icon_view(self, path):
+        # the category can have many directories, and the files are
+        # displayed and searched by the translated names,
+        # then the files are listed from the catalog
+        self.show_icon_view(self._main_path, category)
+        # the thumbnails are created in background only the first time
+        thumbnailcache.create_thumbnails(
+            [(entry['path'], entry['mtime'], entry['size'])
+             for entry in self._catalog.get_entries(category)],
+            PREVIEW_SIZE[0], PREVIEW_SIZE[1])
+
+    def show_icon_view(self, path, category=None):
         self._vbox.remove(self._buttons_vbox)
-        self._toolbar.set_path(path)
+        self._toolbar.set_path(path, category)
         self._icon_view = IconView(self._toolbar)
         self._icon_view.connect('entry-activated',
                                 self.__entry_activated_cb)
@@ -204,6 +184,8 @@ class ImageFileChooser(Gtk.Window):
         self._toolbar.show()
 
     def __go_back_cb(self, toolbar):
+        # the queries from the categories buttons search all the categories
+        self._toolbar.set_path(self._main_path)
         self.show_categories_buttons()
 
     def __realize_cb(self, chooser, parent):
@@ -225,6 +207,13 @@ class ImageFileChooser(Gtk.Window):
     def __delete_event_cb(self, chooser, event):
         self.emit('response', Gtk.ResponseType.DELETE_EVENT)
 
+    def __destroy_cb(self, chooser):
+        # the previews are not needed until the chooser is opened again
+        clear_preview_cache()
+        # write the changes found in the categories browsed
+        if self._catalog is not None:
+            self._catalog.save()
+
     def __key_press_event_cb(self, widget, event):
         keyname = Gdk.keyval_name(event.keyval)
         if keyname == 'Escape':
@@ -237,11 +226,15 @@ class ImageFileChooser(Gtk.Window):
         return self._selected_object_id
 
     def __query_changed_cb(self, toolbar, query):
-        if 'query' in query and len(query['query']) < 3:
+        # the catalog searches in an index, but without categories
+        # all the files are read in every query
+        if 'catalog' not in query and 'query' in query and \
+                len(query['query']) < 3:
             logging.error('Don\'t query with a filter of less than 3 letters'
                           'to avoid big querys, slow in the XO-1')
             return
-        if query['mountpoints'][0] == self._main_path and 'query' not in query:
+        if self._categories is not None and 'query' not in query and \
+                self._toolbar.get_category() is None:
             self.show_categories_buttons()
             return
         if self._icon_view is None:
@@ -305,9 +298,13 @@ class SearchToolbox(ToolbarBox):
         'go-back': (GObject.SignalFlags.RUN_FIRST, None, ([])),
     }
 
-    def __init__(self, path, add_back_button=False):
+    def __init__(self, path, add_back_button=False, catalog=None,
+                 categories=None):
         ToolbarBox.__init__(self)
         self._path = path
+        self._catalog = catalog
+        self._categories = categories
+        self._category = None
         self.search_entry = iconentry.IconEntry()
         try:
             self.search_entry.set_icon_from_name(iconentry.ICON_ENTRY_PRIMARY,
@@ -348,14 +345,29 @@ class SearchToolbox(ToolbarBox):
     def get_query(self):
         return self._query
 
-    def set_path(self, path):
+    def get_category(self):
+        return self._category
+
+    def set_path(self, path, category=None):
+        """
+        Set the directory where the images are searched
+        category -- if set, the images are searched in this category
+            of the catalog, else in all the categories
+        """
         self._path = path
+        self._category = category
         self._query = self._build_query()
         self._update_if_needed()
 
     def _build_query(self):
         query = {}
         query['mountpoints'] = [self._path]
+        if self._catalog is not None:
+            query['catalog'] = self._catalog
+            if self._category is not None:
+                query['categories'] = [self._category]
+            else:
+                query['categories'] = sorted(self._categories.keys())
 
         generic_type = mime.get_generic_type('Image')
         mime_types = generic_type.mime_types
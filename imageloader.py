@@ -0,0 +1,516 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Decode image files, in the main loop or in a background thread.
+
+The images are converted once to cairo surfaces, to be painted without
+more conversions. If librsvg is available, the svg images are kept
+as vectors and rendered at the size needed."""
+
+import cairo
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from gi.repository import Gdk
+from gi.repository import GdkPixbuf
+try:
+    from gi.repository import Rsvg
+except ImportError:
+    Rsvg = None
+
+from lrucache import LRUCache
+from lrucache import get_surface_size
+from workqueue import WorkQueue
+from workqueue import PRIORITY_DEFAULT
+from workqueue import PRIORITY_LOW
+
+# size of the blocks read from the files and sent to the pixbuf loader
+CHUNK_SIZE = 64 * 1024
+# memory used to keep the decoded images, in bytes
+CACHE_SIZE = 32 * 1024 * 1024
+# number of rendered sizes kept for every svg image
+SVG_SIZES_CACHED = 3
+# a svg image rendered at other size is not used if needs to be
+# scaled up more than this, is rendered again
+SVG_MAX_UPSCALE = 2
+# estimated memory used by a parsed svg image, in bytes
+SVG_HANDLE_SIZE = 64 * 1024
+# max size used to find the transparent margins of the images
+TRIM_SAMPLE_SIZE = 256
+
+_queue = WorkQueue()
+# the decoded images, by (path, width, height)
+_cache = LRUCache(CACHE_SIZE, lambda image: get_memory_size(image))
+# the jobs decoding images, by (path, width, height)
+_pending = {}
+
+
+def get_memory_size(image):
+    """Return the memory used by a ImageSurface or a SvgImage, in bytes"""
+    if isinstance(image, SvgImage):
+        return image.get_memory_size()
+    return get_surface_size(image)
+
+
+def _size_prepared_cb(loader, width, height, max_width, max_height):
+    # scale the image to fit in the requested size, keeping the aspect
+    scale = min(float(max_width) / width, float(max_height) / height)
+    loader.set_size(max(1, int(width * scale)), max(1, int(height * scale)))
+
+
+def decode_pixbuf(path, width=-1, height=-1, job=None):
+    """
+    Decode the image in path and return a Pixbuf.
+    width, height -- if set, the image is scaled to fit in that size,
+        keeping the aspect ratio
+    job -- if set, the decoding is stopped when the job is cancelled
+    Return None if the file could not be decoded or the job was cancelled
+    """
+    loader = GdkPixbuf.PixbufLoader()
+    if width > 0 and height > 0:
+        loader.connect('size-prepared', _size_prepared_cb, width, height)
+    try:
+        with open(path, 'rb') as image_file:
+            while True:
+                if job is not None and job.cancelled:
+                    break
+                data = image_file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                loader.write(data)
+        if job is not None and job.cancelled:
+            _close_loader(loader)
+            return None
+        loader.close()
+    except Exception:
+        logging.exception('Error decoding image %s', path)
+        _close_loader(loader)
+        return None
+    return loader.get_pixbuf()
+
+
+def _close_loader(loader):
+    try:
+        loader.close()
+    except Exception:
+        # the loader fails if is closed before receiving all the data
+        pass
+
+
+def pixbuf_to_surface(pixbuf):
+    """
+    Return a cairo ImageSurface with the content of the pixbuf,
+    if the pixbuf does not have alpha, the surface does not have it either
+    """
+    if pixbuf.get_has_alpha():
+        surface_format = cairo.FORMAT_ARGB32
+    else:
+        surface_format = cairo.FORMAT_RGB24
+    surface = cairo.ImageSurface(surface_format, pixbuf.get_width(),
+                                 pixbuf.get_height())
+    ctx = cairo.Context(surface)
+    Gdk.cairo_set_source_pixbuf(ctx, pixbuf, 0, 0)
+    ctx.paint()
+    surface.flush()
+    return surface
+
+
+def decode_surface(path, width=-1, height=-1, job=None):
+    """
+    Same as decode_pixbuf, but return a cairo ImageSurface
+    """
+    pixbuf = decode_pixbuf(path, width, height, job)
+    if pixbuf is None:
+        return None
+    return pixbuf_to_surface(pixbuf)
+
+
+class SvgImage():
+    """
+    A svg image, rendered as a vector to a surface at the size requested.
+    Have the same get_width() and get_height() methods than a
+    ImageSurface, returning the natural size of the image.
+    """
+
+    def __init__(self, handle, cache_key=None):
+        """
+        cache_key -- the key of the image in the cache, used to update
+            the memory used when other sizes are rendered
+        """
+        self._handle = handle
+        self._cache_key = cache_key
+        dimensions = handle.get_dimensions()
+        self._width = dimensions.width
+        self._height = dimensions.height
+        # the surfaces rendered, by size
+        self._surfaces = OrderedDict()
+        # the handle can't be used by two threads at the same time
+        self._lock = threading.Lock()
+
+    def get_width(self):
+        return self._width
+
+    def get_height(self):
+        return self._height
+
+    def get_surface(self, width, height, exact=True):
+        """
+        Return a ImageSurface with the image rendered at width x height.
+        If exact is False, a surface already rendered at other size can be
+        returned, useful to avoid rendering while the size is changing.
+        """
+        with self._lock:
+            if (width, height) in self._surfaces:
+                # keep the sizes used more recently at the end
+                surface = self._surfaces.pop((width, height))
+                self._surfaces[(width, height)] = surface
+                return surface
+            if not exact:
+                surface = self._get_closest_surface(width, height)
+                if surface is not None:
+                    return surface
+            surface = self._render(width, height)
+            self._surfaces[(width, height)] = surface
+            while len(self._surfaces) > SVG_SIZES_CACHED:
+                self._surfaces.popitem(last=False)
+        if self._cache_key is not None:
+            _cache.update_size(self._cache_key)
+        return surface
+
+    def render(self, width, height):
+        """
+        Return a new ImageSurface with the image rendered at
+        width x height, without keeping it with the sizes cached
+        """
+        with self._lock:
+            return self._render(width, height)
+
+    def _render(self, width, height):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        ctx.scale(float(width) / self._width, float(height) / self._height)
+        self._handle.render_cairo(ctx)
+        surface.flush()
+        return surface
+
+    def _get_closest_surface(self, width, height):
+        """
+        Return the smallest surface rendered not smaller than width,
+        or the biggest if all are smaller, or None if would be scaled up
+        more than SVG_MAX_UPSCALE
+        """
+        sizes = sorted(self._surfaces.keys())
+        if not sizes or sizes[-1][0] * SVG_MAX_UPSCALE < width:
+            return None
+        for size in sizes:
+            if size[0] >= width:
+                return self._surfaces[size]
+        return self._surfaces[sizes[-1]]
+
+    def get_memory_size(self):
+        # the image is not kept decoded at the natural size, only the
+        # surfaces rendered
+        with self._lock:
+            return sum(get_surface_size(surface)
+                       for surface in self._surfaces.values()) + \
+                SVG_HANDLE_SIZE
+
+
+def _is_svg(path):
+    # the files in the instance directory don't have extension,
+    # then the format is detected from the content
+    file_info = GdkPixbuf.Pixbuf.get_file_info(path)
+    image_format = file_info[0]
+    return image_format is not None and image_format.get_name() == 'svg'
+
+
+def decode_image(path, width=-1, height=-1, job=None):
+    """
+    Decode a image, if the size is not set and is a svg image,
+    return a SvgImage, otherwise return a ImageSurface.
+    Return None if the image could not be decoded.
+    """
+    if width == -1 and height == -1 and Rsvg is not None and \
+            _is_svg(path):
+        try:
+            return SvgImage(Rsvg.Handle.new_from_file(path),
+                            (path, width, height))
+        except Exception:
+            logging.exception('Error loading svg image %s', path)
+            return None
+    return decode_surface(path, width, height, job)
+
+
+def get_image_surface(image, width=None, height=None, exact=True):
+    """
+    Return a ImageSurface to paint the image, if the image is a
+    SvgImage, rendered to width x height (by default, the natural size)
+    """
+    if isinstance(image, SvgImage):
+        if width is None:
+            width, height = image.get_width(), image.get_height()
+        return image.get_surface(width, height, exact)
+    return image
+
+
+def get_natural_size(path):
+    """
+    Return the size of the image in the file, reading only the header,
+    or None if the format is not recognized
+    """
+    image_format, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+    if image_format is None:
+        return None
+    return width, height
+
+
+def get_opaque_bounds(path, job=None):
+    """
+    Return the rectangle (x, y, width, height) containing all the not
+    transparent pixels of the image, as fractions of the image size,
+    or None if the image does not have transparent margins.
+    The image is decoded at a reduced size, and the rectangle expanded
+    one sample to not cut any pixel with the lost precision.
+    job -- if set, the decoding is stopped when the job is cancelled
+    """
+    pixbuf = decode_pixbuf(path, TRIM_SAMPLE_SIZE, TRIM_SAMPLE_SIZE, job)
+    if pixbuf is None or not pixbuf.get_has_alpha():
+        return None
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    n_channels = pixbuf.get_n_channels()
+    rowstride = pixbuf.get_rowstride()
+    pixels = bytearray(pixbuf.get_pixels())
+    min_col, max_col = width, -1
+    min_row, max_row = height, -1
+    for row in range(height):
+        start = row * rowstride + n_channels - 1
+        alphas = pixels[start:start + width * n_channels:n_channels]
+        if not any(alphas):
+            continue
+        min_row = min(min_row, row)
+        max_row = row
+        cols = [col for col in range(width) if alphas[col]]
+        min_col = min(min_col, cols[0])
+        max_col = max(max_col, cols[-1])
+    if max_row == -1:
+        # completely transparent
+        return None
+    min_col, min_row = max(0, min_col - 1), max(0, min_row - 1)
+    max_col, max_row = min(width - 1, max_col + 1), min(height - 1,
+                                                        max_row + 1)
+    if (min_col, min_row, max_col, max_row) == \
+            (0, 0, width - 1, height - 1):
+        return None
+    return (float(min_col) / width, float(min_row) / height,
+            float(max_col - min_col + 1) / width,
+            float(max_row - min_row + 1) / height)
+
+
+def _opaque_bounds_job(job, path):
+    return get_opaque_bounds(path, job)
+
+
+def load_opaque_bounds_async(path, callback):
+    """
+    Find the opaque bounds of the image in a background thread, and call
+    callback in the main loop with the path and the bounds.
+    Return the Job object, can be used to cancel it.
+    """
+    return _queue.add(_opaque_bounds_job, (path,),
+                      lambda job, bounds: callback(path, bounds))
+
+
+def _get_mip_size(natural_width, natural_height, level):
+    divisor = 2 ** level
+    return (int(math.ceil(float(natural_width) / divisor)),
+            int(math.ceil(float(natural_height) / divisor)))
+
+
+def _get_mip_level(natural_width, natural_height, width, height):
+    # the smallest level big enough to paint the image at width x height
+    level = 0
+    while True:
+        mip_width, mip_height = _get_mip_size(natural_width, natural_height,
+                                              level + 1)
+        if mip_width < width or mip_height < height or \
+                (mip_width, mip_height) == (1, 1):
+            return level
+        level += 1
+
+
+def get_cached_scaled(path, natural_width, natural_height, width, height):
+    """
+    Return a reduced level of the image, already decoded by load_scaled,
+    big enough to paint it at width x height, or None if there is not one
+    in the cache. Never decodes the image.
+    """
+    level = _get_mip_level(natural_width, natural_height, width, height)
+    for cached_level in range(level, 0, -1):
+        key = (path,) + _get_mip_size(natural_width, natural_height,
+                                      cached_level)
+        # probe first, to not count as misses the levels not decoded
+        if key in _cache:
+            return _cache.get(key)
+    return None
+
+
+def load_scaled_async(path, natural_width, natural_height, width, height,
+                      callback, priority=PRIORITY_DEFAULT):
+    """
+    Decode in a background thread the reduced level of the image used
+    by get_cached_scaled for width x height, and call callback as in
+    load_async. Return a LoadRequest, or None if the level needed is the
+    natural size.
+    """
+    level = _get_mip_level(natural_width, natural_height, width, height)
+    if level == 0:
+        return None
+    mip_width, mip_height = _get_mip_size(natural_width, natural_height,
+                                          level)
+    # decoded to the same key used by load_scaled
+    return load_async(path, mip_width, mip_height, callback, priority)
+
+
+def load_scaled(path, width, height):
+    """
+    Return the image, decoded at the smallest size natural_size / 2^n
+    big enough to paint it at width x height, without scaling up.
+    The decoded levels are kept in the cache, and a bigger level already
+    decoded is used if available.
+    The loader scales the image while decoding, and in the case of jpeg
+    images only decodes the needed pixels.
+    Can be called from any thread.
+    """
+    natural_size = get_natural_size(path)
+    if natural_size is None or (Rsvg is not None and _is_svg(path)):
+        # svg images are always rendered at the size needed
+        image = _cache.get((path, -1, -1))
+        if image is None:
+            image = decode_image(path)
+            if image is not None:
+                _cache.put((path, -1, -1), image)
+        return image
+
+    natural_width, natural_height = natural_size
+    level = _get_mip_level(natural_width, natural_height, width, height)
+
+    # look for the level needed, or a bigger one already decoded
+    for cached_level in range(level, -1, -1):
+        if cached_level == 0:
+            key = (path, -1, -1)
+        else:
+            key = (path,) + _get_mip_size(natural_width, natural_height,
+                                          cached_level)
+        image = _cache.get(key)
+        if image is not None:
+            return image
+
+    if level == 0:
+        key = (path, -1, -1)
+        image = decode_surface(path)
+    else:
+        key = (path,) + _get_mip_size(natural_width, natural_height, level)
+        image = decode_surface(path, key[1], key[2])
+    if image is not None:
+        _cache.put(key, image)
+    return image
+
+
+def _decode_job(job, path, width, height):
+    start_time = time.time()
+    image = decode_image(path, width, height, job)
+    job.decode_time = time.time() - start_time
+    return image
+
+
+class LoadRequest():
+    """
+    A request to load a image. Several requests for the same image
+    share the same decoding job, the job is cancelled when all the
+    requests are cancelled.
+    """
+
+    def __init__(self, job, callback):
+        self._job = job
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self._job.requests.remove(self)
+        if not self._job.requests:
+            self._job.cancel()
+            if _pending.get(self._job.key) is self._job:
+                del _pending[self._job.key]
+
+    def get_decode_time(self):
+        """Return the time used to decode the image, in seconds"""
+        return getattr(self._job, 'decode_time', 0)
+
+
+def get_cached(path, width=-1, height=-1):
+    """
+    Return the image (a ImageSurface or a SvgImage) if was already
+    decoded to this size, or None
+    """
+    return _cache.get((path, width, height))
+
+
+def load_async(path, width, height, callback, priority=PRIORITY_DEFAULT):
+    """
+    Decode the image in a background thread, and call callback in the
+    main loop with the request and the image (or None if failed).
+    If the same image is already being decoded, the job is shared,
+    and the priority raised if needed.
+    Return a LoadRequest, can be used to cancel the load.
+    """
+    key = (path, width, height)
+    job = _pending.get(key)
+    if job is None:
+        job = _queue.add(_decode_job, key, _job_done_cb, priority)
+        job.key = key
+        job.requests = []
+        _pending[key] = job
+    elif priority < job.priority:
+        _queue.set_priority(job, priority)
+    request = LoadRequest(job, callback)
+    job.requests.append(request)
+    return request
+
+
+def prefetch(path, width=-1, height=-1):
+    """
+    Decode the image with low priority and keep it in the cache.
+    Return a LoadRequest, or None if the image is already cached.
+    """
+    if (path, width, height) in _cache:
+        return None
+    return load_async(path, width, height, None, PRIORITY_LOW)
+
+
+def _job_done_cb(job, image):
+    if _pending.get(job.key) is job:
+        del _pending[job.key]
+    if image is not None:
+        _cache.put(job.key, image)
+    for request in job.requests[:]:
+        if request.callback is not None:
+            request.callback(request, image)
@@ -415,6 +415,58 @@ class InplaceResultSet(BaseResultSet):
         return
 
 
+class CatalogResultSet(BaseResultSet):
+    """Encapsulates the result of a query on categories of a media catalog
+    """
+    def __init__(self, query, page_size, catalog, categories):
+        BaseResultSet.__init__(self, query, page_size)
+        self._catalog = catalog
+        self._categories = categories
+        self._file_list = None
+        self._sort = query.get('order_by', ['+timestamp'])[0]
+
+    def setup(self):
+        # the catalog only read again the directories modified
+        self._file_list = self._catalog.search(self._categories,
+                                               self._query.get('query', ''))
+        if self._sort[1:] == 'filesize':
+            keygetter = itemgetter('size')
+        else:
+            # timestamp
+            keygetter = itemgetter('mtime')
+        self._file_list = sorted(self._file_list, key=keygetter,
+                                 reverse=(self._sort[0] != '-'))
+        self.ready.send(self)
+
+    def find(self, query):
+        if self._file_list is None:
+            raise ValueError('Need to call setup() first')
+
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', len(self._file_list)))
+        total_count = len(self._file_list)
+
+        entries = []
+        for entry in self._file_list[offset:offset + limit]:
+            entries.append({'uid': entry['path'],
+                            'title': entry['name'],
+                            'timestamp': entry['mtime'],
+                            'filesize': entry['size'],
+                            'mime_type': entry['mime_type'],
+                            'activity': '',
+                            'activity_id': '',
+                            'icon-color': '#000000,#ffffff',
+                            'description': entry['path'],
+                            'mountpoint': os.path.dirname(entry['path'])})
+        return entries, total_count
+
+    def find_ids(self, query):
+        if self._file_list is None:
+            raise ValueError('Need to call setup() first')
+
+        return [entry['path'] for entry in self._file_list]
+
+
 def _get_file_metadata(path, stat, fetch_preview=True):
     """Return the metadata from the corresponding file.
 
@@ -491,6 +543,13 @@ def find(query_, page_size):
     """
     query = query_.copy()
 
+    # the categories of the media catalog are not directories
+    catalog = query.pop('catalog', None)
+    if catalog is not None:
+        query.pop('mountpoints', None)
+        return CatalogResultSet(query, page_size, catalog,
+                                query.pop('categories'))
+
     mount_points = query.pop('mountpoints', ['/'])
     if mount_points is None or len(mount_points) != 1:
         raise ValueError('Exactly one mount point must be specified')
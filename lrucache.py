@@ -0,0 +1,152 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# the memory available is read at most once in this time, in seconds
+MEMORY_CHECK_INTERVAL = 1
+
+_last_memory_check = 0
+_available_memory = None
+
+
+def get_available_memory():
+    """
+    Return the memory available in the system in bytes, or None if
+    is not known. The value is read again only after
+    MEMORY_CHECK_INTERVAL, then can be called frequently.
+    """
+    global _last_memory_check, _available_memory
+    now = time.time()
+    if now - _last_memory_check < MEMORY_CHECK_INTERVAL:
+        return _available_memory
+    _last_memory_check = now
+    values = {}
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                name, value = line.split(':', 1)
+                values[name] = int(value.split()[0]) * 1024
+    except (IOError, ValueError):
+        logging.exception('Error reading the available memory')
+        _available_memory = None
+        return None
+    if 'MemAvailable' in values:
+        _available_memory = values['MemAvailable']
+    else:
+        # older kernels
+        _available_memory = values.get('MemFree', 0) + \
+            values.get('Cached', 0)
+    return _available_memory
+
+
+def get_pixbuf_size(pixbuf):
+    """Return the memory used by the pixels of a Pixbuf, in bytes"""
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+def get_surface_size(surface):
+    """Return the memory used by the pixels of a ImageSurface, in bytes"""
+    return surface.get_stride() * surface.get_height()
+
+
+class LRUCache():
+    """
+    Keep the values used more recently, while the sum of their sizes
+    is lower than max_bytes.
+    size_function -- receives a value and returns its size in bytes
+    """
+
+    def __init__(self, max_bytes, size_function):
+        self._max_bytes = max_bytes
+        self._size_function = size_function
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # number of get calls finding and not finding the key
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # move the entry to the end, the most recently used
+            value, size = self._entries.pop(key)
+            self._entries[key] = (value, size)
+            return value
+
+    def put(self, key, value):
+        size = self._size_function(value)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if size > self._max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._evict(self._max_bytes)
+
+    def update_size(self, key):
+        """Measure again the value, if the memory used by it changed"""
+        with self._lock:
+            if key not in self._entries:
+                return
+            value, size = self._entries[key]
+            new_size = self._size_function(value)
+            self._entries[key] = (value, new_size)
+            self._bytes += new_size - size
+            self._evict(self._max_bytes)
+
+    def remove(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def shrink(self, max_bytes):
+        """Remove the values used less recently, to use at most max_bytes"""
+        with self._lock:
+            self._evict(max_bytes)
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict(max_bytes)
+
+    def get_bytes(self):
+        return self._bytes
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, max_bytes):
+        # called with the lock acquired
+        while self._bytes > max_bytes and self._entries:
+            key, (value, size) = self._entries.popitem(last=False)
+            self._bytes -= size
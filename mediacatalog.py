@@ -0,0 +1,409 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Keep an index of the media files in the categories of the choosers.
+
+The index is stored in the activity data directory, and updated
+reading only the directories modified since the last time. While the
+activity is running, the directories are monitored to read again only
+the modified ones, and notify the changes to the views. The file
+names are stored without translation, the translations are applied
+when the entries are displayed or searched."""
+
+import errno
+import json
+import logging
+import os
+
+from gi.repository import Gio
+from gi.repository import GLib
+
+from sugar3.activity import activity
+
+from jarabelocal.journal import model
+from searchindex import SearchIndex
+
+MEDIA_MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'gif': 'image/gif',
+}
+
+# change if the format of the stored data is modified
+CATALOG_VERSION = 3
+
+# time to wait after a directory changed, to notify all the changes
+# of a copy or removal of many files together, in ms
+MONITOR_DELAY = 500
+
+# the files read or indexed in every step of update_category,
+# to not block the user interface with big directories
+FILES_PER_STEP = 50
+
+# the journal metadata fields searched
+METADATA_FIELDS = ['title', 'description', 'tags', 'fulltext']
+
+# position of the values in the file records
+_FILE_NAME = 0
+_MIME_TYPE = 1
+_SIZE = 2
+_MTIME = 3
+_METADATA = 4
+
+_catalog = None
+
+
+def get_catalog(translations=None):
+    """
+    Return the catalog shared by all the choosers
+    translations -- used to translate the file names,
+        as in imagechooser.ImageFileChooser
+    """
+    global _catalog
+    if _catalog is None:
+        _catalog = MediaCatalog(translations)
+    else:
+        _catalog.set_translations(translations)
+    return _catalog
+
+
+class MediaCatalog():
+
+    def __init__(self, translations=None, catalog_path=None):
+        if catalog_path is None:
+            catalog_path = os.path.join(activity.get_activity_root(), 'data',
+                                        'media_catalog.json')
+        self._catalog_path = catalog_path
+        self._translations = translations
+        # the directories read, by path, the values are dicts with
+        # the mtime, the category, the subdirectories and the records
+        # [file name, mime type, size, mtime, metadata]
+        # of the media files, metadata is the text of the journal
+        # metadata fields, if the file has them
+        self._directories = {}
+        # the paths of the categories, by category name
+        self._categories = {}
+        # the entries of the categories already refreshed, by name
+        self._entries = {}
+        # the search index of every category, and the directories
+        # indexed, by name
+        self._indexes = {}
+        # the directory monitors, by path
+        self._monitors = {}
+        # the categories with directories not monitored, that need to be
+        # checked every time are used
+        self._not_monitored = set()
+        # the directories changed, not notified yet
+        self._changed_directories = set()
+        self._changed_timeout_id = None
+        self._modified = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._catalog_path) as catalog_file:
+                data = json.load(catalog_file)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logging.exception('Error reading the media catalog')
+            return
+        except ValueError:
+            logging.exception('Error reading the media catalog')
+            return
+        if data.get('version') != CATALOG_VERSION:
+            return
+        self._directories = data['directories']
+
+    def save(self):
+        """Write the catalog, if was modified"""
+        if not self._modified:
+            return
+        data = {'version': CATALOG_VERSION, 'directories': self._directories}
+        # write to other file and rename, to not leave a broken catalog
+        temp_path = self._catalog_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as catalog_file:
+                json.dump(data, catalog_file)
+            os.rename(temp_path, self._catalog_path)
+            self._modified = False
+        except EnvironmentError:
+            logging.exception('Error writing the media catalog')
+
+    def _translate(self, file_name):
+        if self._translations is not None and \
+                file_name in self._translations:
+            return self._translations[file_name]
+        return file_name
+
+    def set_translations(self, translations):
+        if translations != self._translations:
+            self._translations = translations
+            # the entries and indexes are created again with the new names
+            self._entries = {}
+            self._indexes = {}
+
+    def add_category(self, category, paths):
+        if self._categories.get(category) != paths:
+            self._categories[category] = paths
+            self._entries.pop(category, None)
+            self._indexes.pop(category, None)
+
+    def _read_directory(self, path, category):
+        """
+        Read the directory again if was modified, the data is stored
+        in self._directories, or removed if does not exist.
+        Is a generator, yielding after every FILES_PER_STEP files.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logging.exception('Error reading directory %r', path)
+            if path in self._directories:
+                del self._directories[path]
+                self._modified = True
+            return
+
+        directory = self._directories.get(path)
+        if directory is not None and directory['mtime'] == mtime and \
+                directory['category'] == category:
+            return
+
+        logging.debug('Reading media directory %r', path)
+        directory = {'mtime': mtime, 'category': category,
+                     'directories': [], 'files': []}
+        try:
+            names = os.listdir(path)
+        except OSError:
+            logging.exception('Error reading directory %r', path)
+            names = []
+        has_metadata = model.JOURNAL_METADATA_DIR in names
+        read_files = 0
+        for name in sorted(names):
+            if name.startswith('.'):
+                continue
+            read_files += 1
+            if read_files % FILES_PER_STEP == 0:
+                yield
+            full_path = os.path.join(path, name)
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            if os.path.isdir(full_path):
+                directory['directories'].append(full_path)
+                continue
+            extension = name[name.rfind('.') + 1:].lower()
+            if extension not in MEDIA_MIME_TYPES:
+                continue
+            metadata = ''
+            if has_metadata:
+                metadata = self._read_metadata(path, name)
+            directory['files'].append(
+                [name, MEDIA_MIME_TYPES[extension], stat.st_size,
+                 int(stat.st_mtime), metadata])
+        # stored when is complete, the catalog can be used while
+        # the directory is read
+        self._directories[path] = directory
+        self._modified = True
+
+    def _monitor_directory(self, path):
+        """Return False if the directory can't be monitored"""
+        if path in self._monitors:
+            return True
+        try:
+            monitor = Gio.File.new_for_path(path).monitor_directory(
+                Gio.FileMonitorFlags.NONE, None)
+        except GLib.GError:
+            logging.exception('Error monitoring directory %r', path)
+            return False
+        monitor.connect('changed', self.__directory_changed_cb, path)
+        self._monitors[path] = monitor
+        return True
+
+    def _stop_monitor(self, path):
+        monitor = self._monitors.pop(path, None)
+        if monitor is not None:
+            monitor.cancel()
+
+    def __directory_changed_cb(self, monitor, changed_file, other_file,
+                               event_type, path):
+        if event_type not in (Gio.FileMonitorEvent.CREATED,
+                              Gio.FileMonitorEvent.DELETED,
+                              Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                              Gio.FileMonitorEvent.MOVED):
+            return
+        directory = self._directories.get(path)
+        if directory is not None:
+            # read again only this directory, the next time
+            # the category is used
+            directory['mtime'] = None
+            self._entries.pop(directory['category'], None)
+        self._changed_directories.add(path)
+        if self._changed_timeout_id is None:
+            self._changed_timeout_id = GLib.timeout_add(
+                MONITOR_DELAY, self.__notify_changes_cb)
+
+    def __notify_changes_cb(self):
+        self._changed_timeout_id = None
+        for path in self._changed_directories:
+            model.updated.send(None, object_id=path)
+        self._changed_directories = set()
+        return False
+
+    def get_category(self, path):
+        """
+        Return the category of a file or a directory in the catalog,
+        or None if was not found
+        """
+        directory = self._directories.get(path)
+        if directory is None:
+            directory = self._directories.get(os.path.dirname(path))
+        if directory is None:
+            return None
+        return directory['category']
+
+    def _read_metadata(self, path, name):
+        """Return the text of the metadata fields searched"""
+        metadata_path = os.path.join(path, model.JOURNAL_METADATA_DIR,
+                                     name + '.metadata')
+        if not os.path.exists(metadata_path):
+            return ''
+        try:
+            with open(metadata_path) as metadata_file:
+                metadata = json.load(metadata_file)
+        except (ValueError, EnvironmentError):
+            logging.error('Could not read metadata for file %r', name)
+            return ''
+        return '\n'.join(unicode(metadata[field]) for field in METADATA_FIELDS
+                         if metadata.get(field))
+
+    def _update_index(self, category, path, directory):
+        """
+        Index the files of the directory, if was read again.
+        Is a generator, yielding after every FILES_PER_STEP files.
+        """
+        index, indexed = self._indexes.setdefault(category,
+                                                  (SearchIndex(), {}))
+        old_directory = indexed.get(path)
+        if old_directory is directory:
+            return
+        if old_directory is not None:
+            for record in old_directory['files']:
+                index.remove(os.path.join(path, record[_FILE_NAME]))
+        if directory is None:
+            del indexed[path]
+            return
+        for count, record in enumerate(directory['files']):
+            index.add(os.path.join(path, record[_FILE_NAME]),
+                      [record[_FILE_NAME], self._translate(record[_FILE_NAME]),
+                       record[_METADATA]])
+            if (count + 1) % FILES_PER_STEP == 0:
+                yield
+        indexed[path] = directory
+
+    def get_entries(self, category):
+        """
+        Return a list of dicts with the path, translated name, mime type,
+        size, mtime and category of the media files in the category.
+        The first time in the session, the directories are checked
+        and the modified are read again, after that, only the
+        directories where the monitors found changes.
+        The changes are written when save() is called.
+        """
+        if not self.is_updated(category):
+            for step in self.update_category(category):
+                pass
+        return self._entries[category]
+
+    def is_updated(self, category):
+        return category in self._entries and \
+            category not in self._not_monitored
+
+    def update_category(self, category):
+        """
+        Check the directories of the category, reading again the modified.
+        Is a generator, yielding after every directory and every
+        FILES_PER_STEP files, to be executed in idle time without
+        blocking the user interface.
+        """
+        entries = []
+        pending = list(self._categories.get(category, []))
+        visited = set()
+        read_paths = set()
+        monitored = True
+        while pending:
+            path = pending.pop(0)
+            # avoid loops with symbolic links
+            real_path = os.path.realpath(path)
+            if real_path in visited:
+                continue
+            visited.add(real_path)
+            read_paths.add(path)
+            for step in self._read_directory(path, category):
+                yield
+            directory = self._directories.get(path)
+            for step in self._update_index(category, path, directory):
+                yield
+            yield
+            if directory is None:
+                continue
+            if not self._monitor_directory(path):
+                monitored = False
+            pending.extend(directory['directories'])
+            for record in directory['files']:
+                entries.append({
+                    'path': os.path.join(path, record[_FILE_NAME]),
+                    'name': self._translate(record[_FILE_NAME]),
+                    'mime_type': record[_MIME_TYPE],
+                    'size': record[_SIZE],
+                    'mtime': record[_MTIME],
+                    'category': category})
+        # remove from the index the directories not found now
+        index, indexed = self._indexes.setdefault(category,
+                                                  (SearchIndex(), {}))
+        for path in indexed.keys():
+            if path not in read_paths:
+                for step in self._update_index(category, path, None):
+                    pass
+                self._stop_monitor(path)
+        if monitored:
+            self._not_monitored.discard(category)
+        else:
+            self._not_monitored.add(category)
+        self._entries[category] = entries
+
+    def search(self, categories, text=''):
+        """
+        Return the entries of the categories with all the words in text
+        in the file name, the translated name or the journal metadata.
+        A file in more than one of the categories is returned once.
+        """
+        entries = []
+        found_paths = set()
+        for category in categories:
+            category_entries = self.get_entries(category)
+            if text.split():
+                index, indexed = self._indexes[category]
+                paths = index.search(text)
+                category_entries = [entry for entry in category_entries
+                                    if entry['path'] in paths]
+            for entry in category_entries:
+                if entry['path'] not in found_paths:
+                    found_paths.add(entry['path'])
+                    entries.append(entry)
+        return entries
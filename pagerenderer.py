@@ -0,0 +1,274 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Draw the pages of the book with cairo, without using widgets."""
+
+import cairo
+import hashlib
+import json
+import math
+import time
+
+import imageloader
+from lrucache import LRUCache
+from lrucache import get_surface_size
+
+# color used to draw the images while are decoded
+PLACEHOLDER_COLOR = (0.9, 0.9, 0.9)
+
+# memory used by the images referenced by the recorded pages, in bytes
+RECORDINGS_CACHE_SIZE = 24 * 1024 * 1024
+
+# the recorded pages, by page key, the values are tuples
+# (recording surface, memory used by the images referenced, width, height)
+_recordings = LRUCache(RECORDINGS_CACHE_SIZE, lambda value: value[1])
+
+
+def draw_background(ctx, width, height, background_path, surface):
+    """
+    Draw the background of a page, of size width x height.
+    If the page has a background but the surface is not decoded yet,
+    a placeholder is drawn.
+    """
+    if background_path is None:
+        # draw a white background
+        ctx.rectangle(0, 0, width, height)
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.fill()
+    elif surface is None:
+        ctx.rectangle(0, 0, width, height)
+        ctx.set_source_rgb(*PLACEHOLDER_COLOR)
+        ctx.fill()
+    else:
+        ctx.set_source_surface(surface, 0, 0)
+        ctx.paint()
+
+
+def _get_device_size(ctx, width, height):
+    # the size in pixels of a rectangle with the current transformation
+    dx, dy = ctx.user_to_device_distance(width, 0)
+    device_width = math.sqrt(dx * dx + dy * dy)
+    dx, dy = ctx.user_to_device_distance(0, height)
+    device_height = math.sqrt(dx * dx + dy * dy)
+    return max(1, int(round(device_width))), max(1, int(round(device_height)))
+
+
+def draw_image(ctx, image, x, y, width, height, angle=0, h_mirrored=False,
+               v_mirrored=False, cairo_filter=None, frame_stats=None,
+               trim=None):
+    """
+    Draw a image in the page.
+    image -- a ImageSurface or a imageloader.SvgImage
+    x, y, width, height -- (float) the position and size in points,
+        width and height are the size before the rotation
+    angle -- (int) one of 0, 90, 180 or 270
+    cairo_filter -- if set, the filter used to scale the surface,
+        and the svg images are not rendered again if the size changed
+    frame_stats -- if set, a framestats.FrameStats where the times used
+        to render, set the source and paint the image are added
+    trim -- if set, the rectangle (x, y, width, height) of the image,
+        as fractions of its size, drawn in the box, the rest is not painted
+    If image is None, a placeholder is drawn.
+    """
+    ctx.save()
+    ctx.translate(x, y)
+
+    if angle != 0:
+        radians_angle = math.pi * float(angle) / 180.0
+        ctx.rotate(radians_angle)
+        if angle == 90:
+            ctx.translate(0, -height)
+        elif angle == 180:
+            ctx.translate(-width, -height)
+        elif angle == 270:
+            ctx.translate(-width, 0)
+
+    if angle == 90 or angle == 270:
+        h_mirrored, v_mirrored = v_mirrored, h_mirrored
+
+    if h_mirrored:
+        ctx.translate(width, 0)
+        ctx.scale(-1.0, 1.0)
+    if v_mirrored:
+        ctx.translate(0, height)
+        ctx.scale(1.0, -1.0)
+
+    if image is None:
+        ctx.rectangle(0, 0, width, height)
+        ctx.set_source_rgb(*PLACEHOLDER_COLOR)
+        ctx.fill()
+    else:
+        if trim is not None:
+            trim_x, trim_y, trim_width, trim_height = trim
+            ctx.rectangle(0, 0, width, height)
+            ctx.clip()
+            # place the whole image to fill the box with the trimmed part
+            width = width / trim_width
+            height = height / trim_height
+            ctx.translate(-trim_x * width, -trim_y * height)
+        # the svg images are rendered at the size used in the device
+        device_width, device_height = _get_device_size(ctx, width, height)
+        start_time = time.time()
+        surface = imageloader.get_image_surface(
+            image, device_width, device_height, cairo_filter is None)
+        decoded_time = time.time()
+        scale_x = width / surface.get_width() * 1.0
+        scale_y = height / surface.get_height() * 1.0
+        ctx.scale(scale_x, scale_y)
+        ctx.set_source_surface(surface, 0, 0)
+        if cairo_filter is not None:
+            ctx.get_source().set_filter(cairo_filter)
+        source_time = time.time()
+        ctx.paint()
+        if frame_stats is not None:
+            frame_stats.add_image_times(
+                decoded_time - start_time, source_time - decoded_time,
+                time.time() - source_time, (device_width, device_height))
+    ctx.restore()
+
+
+def draw_border(ctx, width, height):
+    ctx.save()
+    ctx.set_line_width(2)
+    ctx.rectangle(0, 0, width, height)
+    ctx.set_source_rgb(0, 0, 0)
+    ctx.stroke()
+    ctx.restore()
+
+
+def get_page_key(background_path, images):
+    """
+    Return a value identifying the content of a page, changes
+    if the background or any image in the page is changed
+    """
+    return (background_path,) + tuple(
+        (image.path, image.x, image.y, image.width, image.height,
+         image.h_mirrored, image.v_mirrored, image.angle, image.trim)
+        for image in images)
+
+
+def get_page_hash(page_key):
+    """
+    Return a string identifying the content of a page, that can be
+    stored, and is the same after reading the book again
+    """
+    # json encodes str and unicode paths in the same way
+    return hashlib.md5(json.dumps(page_key)).hexdigest()
+
+
+class PageRenderer():
+    """
+    Render a page, described by the background path and a list of
+    bookmodel.Image objects, at any size.
+    The images are decoded at the size needed, using the thread safe
+    imageloader cache. If the cairo bindings support recording surfaces,
+    the drawing operations of every page are recorded once, and replayed
+    with the scale needed while the page is not changed.
+    No other state is kept between calls, then the renderer can be used
+    from several threads at the same time.
+    """
+
+    def render(self, ctx, width, height, background_path, images):
+        if not hasattr(cairo, 'RecordingSurface'):
+            self._draw_page(ctx, width, height, background_path, images)
+        else:
+            key = get_page_key(background_path, images)
+            recording = _recordings.get(key)
+            # the images are decoded at the size recorded, then the page
+            # is recorded again if is needed at a bigger size
+            if recording is None or recording[2] < width or \
+                    recording[3] < height:
+                recording = self._record_page(width, height,
+                                              background_path, images)
+                _recordings.put(key, recording)
+            ctx.save()
+            ctx.rectangle(0, 0, width, height)
+            ctx.clip()
+            ctx.scale(float(width) / recording[2],
+                      float(height) / recording[3])
+            ctx.set_source_surface(recording[0], 0, 0)
+            ctx.paint()
+            ctx.restore()
+        # the border is drawn at the final size to keep the line width
+        draw_border(ctx, width, height)
+
+    def _record_page(self, width, height, background_path, images):
+        """
+        Return a tuple with a RecordingSurface with the page drawn,
+        the memory used by the images it references, and the size
+        """
+        recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+        ctx = cairo.Context(recording)
+        images_size = self._draw_page(ctx, width, height, background_path,
+                                      images)
+        recording.flush()
+        return recording, images_size, width, height
+
+    def _draw_page(self, ctx, width, height, background_path, images):
+        """
+        Draw the background and the images of the page,
+        return the memory used by the images, in bytes
+        """
+        images_size = 0
+        background = None
+        if background_path is not None:
+            background = imageloader.decode_surface(background_path, width,
+                                                    height)
+            if background is not None:
+                images_size += get_surface_size(background)
+        draw_background(ctx, width, height, background_path, background)
+
+        for image in images:
+            natural_size = imageloader.get_natural_size(image.path)
+            if natural_size is None:
+                continue
+            trim_width, trim_height = 1., 1.
+            if image.trim is not None:
+                trim_width, trim_height = image.trim[2:]
+            # the size and position are stored as percentages of the page
+            # if the size is not defined, use the image size
+            image_width = image.width * width / 100.
+            if image.width == 0:
+                image_width = natural_size[0] * trim_width
+            image_height = image.height * height / 100.
+            if image.height == 0:
+                image_height = natural_size[1] * trim_height
+            # decode only the pixels that will be painted
+            decoded_image = imageloader.load_scaled(
+                image.path, *_get_device_size(ctx, image_width / trim_width,
+                                              image_height / trim_height))
+            if decoded_image is None:
+                continue
+            draw_image(ctx, decoded_image, image.x * width / 100.,
+                       image.y * height / 100., image_width, image_height,
+                       image.angle, image.h_mirrored, image.v_mirrored,
+                       trim=image.trim)
+            # the image decoded can be bigger than the size painted,
+            # and is kept while the recording is kept
+            images_size += imageloader.get_memory_size(decoded_image)
+        return images_size
+
+    def create_surface(self, width, height, background_path, images):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        self.render(ctx, width, height, background_path, images)
+        surface.flush()
+        return surface
+
+    def write_to_png(self, dest_path, width, height, background_path,
+                     images):
+        surface = self.create_surface(width, height, background_path, images)
+        surface.write_to_png(dest_path)
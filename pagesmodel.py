@@ -0,0 +1,213 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from gi.repository import GObject
+from gi.repository import Gtk
+
+MAX_TEXT_SIZE = 25
+
+
+class PagesModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource,
+                 Gtk.TreeDragDest):
+    """
+    A model with a row for every page of the book.
+    The values are calculated when the view request them, the thumbnails
+    are obtained calling surface_function with the page, then only the
+    thumbnails of the rows displayed need to be available.
+    """
+    __gtype_name__ = 'WriteBooksPagesModel'
+
+    COLUMN_SURFACE = 0
+    COLUMN_TITLE = 1
+    # the position of the page when the model was set,
+    # used to know how the user reordered the pages
+    COLUMN_ORDER = 2
+
+    _COLUMN_TYPES = {
+        COLUMN_SURFACE: object,
+        COLUMN_TITLE: str,
+        COLUMN_ORDER: int,
+    }
+
+    def __init__(self, surface_function):
+        GObject.GObject.__init__(self)
+        self._surface_function = surface_function
+        self._pages = []
+        self._orders = []
+
+    def set_pages(self, pages):
+        """
+        Update the rows to display the pages, emitting the signals
+        only for the rows added, removed or changed
+        """
+        new_pages = set(pages)
+        for index in reversed(range(len(self._pages))):
+            if self._pages[index] not in new_pages:
+                self._remove_row(index)
+
+        old_pages = set(self._pages)
+        if [page for page in pages if page in old_pages] != self._pages:
+            # the pages were reordered, add all the rows again
+            for index in reversed(range(len(self._pages))):
+                self._remove_row(index)
+
+        for index, page in enumerate(pages):
+            if index >= len(self._pages) or self._pages[index] is not page:
+                self._pages.insert(index, page)
+                self._orders.insert(index, index)
+                self.row_inserted(Gtk.TreePath(index),
+                                  self.get_iter(Gtk.TreePath(index)))
+            elif self._orders[index] != index:
+                self._orders[index] = index
+                self.page_changed(page)
+
+    def _remove_row(self, index):
+        del self._pages[index]
+        del self._orders[index]
+        self.row_deleted(Gtk.TreePath(index))
+
+    def get_page(self, index):
+        return self._pages[index]
+
+    def get_pages(self):
+        return self._pages[:]
+
+    def get_n_pages(self):
+        return len(self._pages)
+
+    def get_index(self, page):
+        """Return the position of the page, or None if is not in the model"""
+        for index, row_page in enumerate(self._pages):
+            if row_page is page:
+                return index
+        return None
+
+    def get_orders(self):
+        return self._orders[:]
+
+    def page_changed(self, page):
+        """Notify the view that the thumbnail or the title changed"""
+        index = self.get_index(page)
+        if index is not None:
+            path = Gtk.TreePath(index)
+            self.row_changed(path, self.get_iter(path))
+
+    def move_row(self, source, dest):
+        """
+        Move the row in the position source before the row in the
+        position dest (or to the end, if dest is the number of rows)
+        """
+        page = self._pages[source]
+        order = self._orders[source]
+        self._remove_row(source)
+        if dest > source:
+            dest -= 1
+        self._pages.insert(dest, page)
+        self._orders.insert(dest, order)
+        path = Gtk.TreePath(dest)
+        self.row_inserted(path, self.get_iter(path))
+
+    def do_get_n_columns(self):
+        return len(PagesModel._COLUMN_TYPES)
+
+    def do_get_column_type(self, index):
+        return PagesModel._COLUMN_TYPES[index]
+
+    def do_iter_n_children(self, iterator):
+        if iterator is None:
+            return len(self._pages)
+        else:
+            return 0
+
+    def do_get_value(self, iterator, column):
+        index = iterator.user_data
+        if index >= len(self._pages):
+            return None
+        page = self._pages[index]
+        if column == PagesModel.COLUMN_SURFACE:
+            return self._surface_function(page)
+        elif column == PagesModel.COLUMN_TITLE:
+            text = page.text.replace('\n', '')
+            if len(text) > MAX_TEXT_SIZE:
+                text = text[0:MAX_TEXT_SIZE - 3] + '...'
+            return text
+        return self._orders[index]
+
+    def do_iter_nth_child(self, parent_iter, n):
+        if parent_iter is not None or n >= len(self._pages):
+            return (False, None)
+        iterator = Gtk.TreeIter()
+        iterator.user_data = n
+        return (True, iterator)
+
+    def do_get_path(self, iterator):
+        treepath = Gtk.TreePath((iterator.user_data,))
+        return treepath
+
+    def do_get_iter(self, path):
+        idx = path.get_indices()[0]
+        if idx >= len(self._pages):
+            return (False, None)
+        iterator = Gtk.TreeIter()
+        iterator.user_data = idx
+        return (True, iterator)
+
+    def do_iter_next(self, iterator):
+        idx = iterator.user_data + 1
+        if idx >= len(self._pages):
+            iterator.stamp = -1
+            return (False, iterator)
+        else:
+            iterator.user_data = idx
+            return (True, iterator)
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_iter_children(self, iterator):
+        return (False, iterator)
+
+    def do_iter_has_child(self, iterator):
+        return False
+
+    def do_iter_parent(self, iterator):
+        return (False, Gtk.TreeIter())
+
+    # drag and drop, used by the view to reorder the pages
+
+    def do_row_draggable(self, path):
+        return True
+
+    def do_drag_data_get(self, path, selection_data):
+        return Gtk.tree_set_row_drag_data(selection_data, self, path)
+
+    def do_drag_data_delete(self, path):
+        # the row was already moved when the data was received
+        return True
+
+    def do_row_drop_possible(self, dest_path, selection_data):
+        valid, model, source_path = Gtk.tree_get_row_drag_data(
+            selection_data)
+        return valid and model is self
+
+    def do_drag_data_received(self, dest_path, selection_data):
+        valid, model, source_path = Gtk.tree_get_row_drag_data(
+            selection_data)
+        if not valid or model is not self:
+            return False
+        self.move_row(source_path.get_indices()[0],
+                      min(dest_path.get_indices()[0], len(self._pages)))
+        return True
@@ -1,18 +1,34 @@
 # Copyright 2015 Gonzalo Odiard
 #
 
+import cairo
+import copy
+
 from gi.repository import GObject
 from gi.repository import Gtk
 from gi.repository import Gdk
-from gi.repository.GdkPixbuf import Pixbuf
 
-from imagecanvas import ImageCanvas
+from bookmodel import write_thumbnail
+from lrucache import LRUCache
+from lrucache import get_surface_size
+from pagerenderer import PageRenderer
+from pagerenderer import PLACEHOLDER_COLOR
+from pagerenderer import draw_border
+from pagerenderer import get_page_hash
+from pagerenderer import get_page_key
+from pagesmodel import PagesModel
+from workqueue import WorkQueue
+from workqueue import PRIORITY_DEFAULT
+from workqueue import PRIORITY_LOW
 
-MAX_TEXT_SIZE = 25
+# memory used to keep the thumbnails, in bytes
+THUMBNAILS_CACHE_SIZE = 12 * 1024 * 1024
+# number of pages before and after the visible ones with the
+# thumbnails prepared, to display them quickly when scrolling
+PRELOAD_PAGES = 8
 
-_PIXBUF_COLUMN = 0
-_TITLE_COLUMN = 1
-_ORDER_COLUMN = 2
+# the thumbnails are rendered in a background thread
+_queue = WorkQueue()
 
 
 class PreviewPanel(Gtk.VBox):
@@ -33,41 +49,230 @@ class PreviewPanel(Gtk.VBox):
         self._icon_view.set_row_spacing(0)
         self._icon_view.set_column_spacing(0)
         self._icon_view.set_margin(0)
+        # the thumbnails are kept as cairo surfaces, and painted directly
+        surface_renderer = Gtk.CellRendererPixbuf()
+        self._icon_view.pack_start(surface_renderer, False)
+        self._icon_view.set_cell_data_func(surface_renderer,
+                                           self._surface_data_func, None)
         # TODO: No logic here.... set a bigger item size
         # display a very width item
         self._icon_view.set_item_width(self._width / 2)
+        # the rows are created when the view needs them
+        self._model = PagesModel(self._get_surface)
+        self._icon_view.set_model(self._model)
+        self._icon_view.set_text_column(PagesModel.COLUMN_TITLE)
+        self._renderer = PageRenderer()
+        self._icon_width = self._width - 50
+        self._icon_height = int(self._icon_width * 3 / 4.)
+        self._placeholder = self._create_placeholder()
+        # the thumbnails of the pages near the visible ones, by page,
+        # the values are tuples (page key, surface)
+        # with big screens, at least the pages near the visible are kept
+        cache_size = max(THUMBNAILS_CACHE_SIZE, get_surface_size(
+            self._placeholder) * PRELOAD_PAGES * 4)
+        self._thumbnails = LRUCache(cache_size,
+                                    lambda value: get_surface_size(value[1]))
+        # the jobs rendering thumbnails, by page
+        self._render_jobs = {}
         self._item_activated_id = self._icon_view.connect(
             'selection-changed', self.__item_activated_cb)
         self._icon_view.connect('drag-end', self.__drag_end_cb)
         self.add(scrolled)
         scrolled.add(self._icon_view)
+        # prepare the thumbnails visible after scrolling or resizing
+        self._vadjustment = scrolled.get_vadjustment()
+        self._vadjustment.connect('value-changed', self.__scrolled_cb)
+        self._vadjustment.connect('changed', self.__scrolled_cb)
+        self.connect('hide', self.__hide_cb)
         self.set_size_request(self._width, -1)
         self.show_all()
 
-    def update_model(self, pages):
-        liststore = Gtk.ListStore(Pixbuf, str, int)
-        self._icon_view.set_model(liststore)
-        self._icon_view.set_pixbuf_column(_PIXBUF_COLUMN)
-        self._icon_view.set_text_column(_TITLE_COLUMN)
-        image_renderer = ImageCanvas()
-        icon_width = self._width - 50
-        icon_height = int(icon_width * 3 / 4.)
-        order = 0
+    def _create_placeholder(self):
+        # displayed while the thumbnail is rendered
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self._icon_width,
+                                     self._icon_height)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(*PLACEHOLDER_COLOR)
+        ctx.paint()
+        draw_border(ctx, self._icon_width, self._icon_height)
+        surface.flush()
+        return surface
+
+    def _surface_data_func(self, view, cell, model, tree_iter, data):
+        cell.props.surface = model.get_value(tree_iter,
+                                             PagesModel.COLUMN_SURFACE)
+
+    def _get_surface(self, page):
+        # called by the model, the view request the values of all the
+        # rows to calculate the layout, then nothing is rendered here
+        thumbnail = self._thumbnails.get(page)
+        if thumbnail is None:
+            return self._placeholder
+        # if the page changed, the old thumbnail is displayed
+        # until the new one is rendered
+        return thumbnail[1]
+
+    def update_model(self, pages, actual_page=None):
+        """
+        Update the rows to display the pages, the thumbnails are
+        prepared only for the pages visible or near them.
+        actual_page -- if set, the number of the page selected
+        """
+        for page in self._render_jobs.keys():
+            if page not in pages:
+                self._render_jobs.pop(page).cancel()
+        self._model.set_pages(pages)
+
+        if actual_page is not None:
+            self._select_path(Gtk.TreePath(actual_page - 1))
+        self._update_thumbnails()
+
+    def update_page(self, page):
+        """
+        Update the thumbnail and the title of a page, if changed.
+        Is used to keep the page being edited updated.
+        """
+        if not self.get_visible():
+            # the rows are updated when the panel is shown
+            return
+        self._model.page_changed(page)
+        self._update_thumbnails()
+
+    def _get_visible_range(self):
+        visible_range = self._icon_view.get_visible_range()
+        if not visible_range or not visible_range[0]:
+            return None
+        return visible_range[1][0], visible_range[2][0]
+
+    def _update_thumbnails(self):
+        """
+        Prepare the thumbnails of the pages visible and near them,
+        the visible first, and cancel the jobs of the other pages
+        """
+        if not self.get_visible():
+            return
+        n_pages = self._model.get_n_pages()
+        visible_range = self._get_visible_range()
+        if visible_range is None:
+            # the view is not displayed yet
+            visible_range = (0, PRELOAD_PAGES)
+        first = max(0, visible_range[0] - PRELOAD_PAGES)
+        last = min(n_pages - 1, visible_range[1] + PRELOAD_PAGES)
+
+        # cancel the jobs of the pages far from the visible ones
+        needed_pages = set(self._model.get_page(index)
+                           for index in range(first, last + 1))
+        for page, job in self._render_jobs.items():
+            if page not in needed_pages and not job.for_book:
+                self._render_jobs.pop(page).cancel()
+
+        visible = range(visible_range[0], min(n_pages, visible_range[1] + 1))
+        near = [index for index in range(first, last + 1)
+                if index not in visible]
+        for index in visible:
+            self._update_thumbnail(self._model.get_page(index),
+                                   PRIORITY_DEFAULT)
+        for index in near:
+            self._update_thumbnail(self._model.get_page(index),
+                                   PRIORITY_LOW)
+
+    def _update_thumbnail(self, page, priority):
+        key = get_page_key(page.background_path, page.images)
+        thumbnail = self._thumbnails.get(page)
+        if thumbnail is not None and thumbnail[0] == key:
+            return
+
+        job = self._render_jobs.get(page)
+        if job is not None:
+            if job.key == key:
+                if job.priority != priority:
+                    _queue.set_priority(job, priority)
+                return
+            self._render_jobs.pop(page).cancel()
+
+        # use the thumbnail stored in the book, if is updated
+        surface = page.load_thumbnail()
+        if surface is not None:
+            self._thumbnails.put(page, (key, self._scale_thumbnail(surface)))
+            self._model.page_changed(page)
+            return
+
+        self._render_thumbnail(page, key, priority)
+
+    def _render_thumbnail(self, page, key, priority, for_book=False):
+        # the worker uses a copy, because the images of the page being
+        # edited are modified in the main thread
+        images = [copy.copy(image) for image in page.images]
+        job = _queue.add(self._render_page, (page.background_path, images,
+                                             get_page_hash(key)),
+                         self.__page_rendered_cb, priority)
+        job.page = page
+        job.key = key
+        # the jobs rendering thumbnails to store in the book are not
+        # cancelled when the page is not displayed
+        job.for_book = for_book
+        self._render_jobs[page] = job
+
+    def render_missing_thumbnails(self, pages):
+        """
+        Render in the background the thumbnails outdated of the pages,
+        even if the panel is not displayed, to be stored in the book
+        the next time is saved
+        """
         for page in pages:
-            text = page.text
-            text = text.replace('\n', '')
-            if len(text) > MAX_TEXT_SIZE:
-                text = text[0:MAX_TEXT_SIZE - 3] + '...'
-            pixbuf = image_renderer.create_pixbuf(
-                icon_width, icon_height, page.background_path, page.images)
-            liststore.append([pixbuf, text, order])
-            order += 1
+            if page in self._render_jobs:
+                continue
+            key = get_page_key(page.background_path, page.images)
+            if not page.has_thumbnail(get_page_hash(key)):
+                self._render_thumbnail(page, key, PRIORITY_LOW, True)
+
+    def _scale_thumbnail(self, thumbnail):
+        # the thumbnails stored can have other size
+        if (thumbnail.get_width(), thumbnail.get_height()) == \
+                (self._icon_width, self._icon_height):
+            return thumbnail
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self._icon_width,
+                                     self._icon_height)
+        ctx = cairo.Context(surface)
+        ctx.scale(float(self._icon_width) / thumbnail.get_width(),
+                  float(self._icon_height) / thumbnail.get_height())
+        ctx.set_source_surface(thumbnail, 0, 0)
+        ctx.paint()
+        surface.flush()
+        return surface
+
+    def _render_page(self, job, background_path, images, page_hash):
+        # executed in the worker thread, the thumbnail is also written
+        # to a file, to be stored in the book without rendering it again
+        surface = self._renderer.create_surface(
+            self._icon_width, self._icon_height, background_path, images)
+        thumbnail_path = write_thumbnail(surface, page_hash)
+        return surface, thumbnail_path, page_hash
+
+    def __page_rendered_cb(self, job, result):
+        if self._render_jobs.get(job.page) is not job:
+            return
+        del self._render_jobs[job.page]
+        surface, thumbnail_path, page_hash = result
+        job.page.set_thumbnail(thumbnail_path, page_hash,
+                               self._model.get_pages())
+        self._thumbnails.put(job.page, (job.key, surface))
+        self._model.page_changed(job.page)
+
+    def __scrolled_cb(self, adjustment):
+        self._update_thumbnails()
+
+    def __hide_cb(self, widget):
+        # the thumbnails not rendered are updated when the panel is shown
+        for page, job in self._render_jobs.items():
+            if not job.for_book:
+                self._render_jobs.pop(page).cancel()
 
     def __item_activated_cb(self, iconview):
         _success, path, renderer = iconview.get_cursor()
         model = iconview.get_model()
         if path is not None:
-            order = model[path][2]
+            order = model[path][PagesModel.COLUMN_ORDER]
             self.emit('page-activated', order + 1)
 
     def update_position(self, delta):
@@ -78,12 +283,16 @@ class PreviewPanel(Gtk.VBox):
                 path.next()
             else:
                 path.prev()
-            self._icon_view.disconnect(self._item_activated_id)
-            self._icon_view.select_path(path)
-            self._icon_view.set_cursor(path, renderer, True)
+            self._select_path(path, renderer)
+
+    def _select_path(self, path, renderer=None):
+        # select without emitting page-activated
+        self._icon_view.disconnect(self._item_activated_id)
+        self._icon_view.select_path(path)
+        self._icon_view.set_cursor(path, renderer, True)
 
-            self._item_activated_id = self._icon_view.connect(
-                'selection-changed', self.__item_activated_cb)
+        self._item_activated_id = self._icon_view.connect(
+            'selection-changed', self.__item_activated_cb)
 
     def __drag_end_cb(self, icon_view, drag_context):
         # check if the pages are unsorted
@@ -95,7 +304,4 @@ class PreviewPanel(Gtk.VBox):
         """
         This is used to check if the user reordered the pages
         """
-        actual_order = []
-        for item in self._icon_view.get_model():
-            actual_order.append(item[_ORDER_COLUMN])
-        return actual_order
+        return self._model.get_orders()
@@ -0,0 +1,130 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Find the documents containing a text, without reading all of them.
+
+The words of the documents are split in grams of one, two and three
+letters, and for every gram is kept the set of documents using it.
+A searched word is looked up by its grams, and only the documents
+having all of them are compared with the word."""
+
+import re
+
+# the longest grams indexed, longer words are searched by the
+# intersection of their grams
+MAX_GRAM_SIZE = 3
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _to_unicode(text):
+    if isinstance(text, unicode):
+        return text
+    return text.decode('utf-8', 'replace')
+
+
+def _get_grams(token):
+    grams = set()
+    for size in range(1, min(len(token), MAX_GRAM_SIZE) + 1):
+        for start in range(len(token) - size + 1):
+            grams.add(token[start:start + size])
+    return grams
+
+
+class SearchIndex():
+
+    def __init__(self):
+        # the text of every document, in lower case, by id
+        self._texts = {}
+        # the ids of the documents with every gram, by gram
+        self._postings = {}
+
+    def add(self, doc_id, texts):
+        """
+        Add or replace a document
+        texts -- a list of strings, searched as if were a single text
+        """
+        self.remove(doc_id)
+        text = u'\n'.join(_to_unicode(text) for text in texts).lower()
+        self._texts[doc_id] = text
+        for gram in self._get_text_grams(text):
+            self._postings.setdefault(gram, set()).add(doc_id)
+
+    def remove(self, doc_id):
+        text = self._texts.pop(doc_id, None)
+        if text is None:
+            return
+        for gram in self._get_text_grams(text):
+            doc_ids = self._postings[gram]
+            doc_ids.discard(doc_id)
+            if not doc_ids:
+                del self._postings[gram]
+
+    def _get_text_grams(self, text):
+        grams = set()
+        for token in _TOKEN_RE.findall(text):
+            grams.update(_get_grams(token))
+        return grams
+
+    def __contains__(self, doc_id):
+        return doc_id in self._texts
+
+    def __len__(self):
+        return len(self._texts)
+
+    def search(self, query):
+        """
+        Return the set of ids of the documents containing all the
+        words in query, as substrings and ignoring the case
+        """
+        result = None
+        for word in _to_unicode(query).lower().split():
+            candidates = self._get_candidates(word)
+            if result is None:
+                result = candidates
+            else:
+                result = result & candidates
+            if not result:
+                return set()
+        if result is None:
+            return set(self._texts.keys())
+        return result
+
+    def _get_candidates(self, word):
+        grams = set()
+        for token in _TOKEN_RE.findall(word):
+            if len(token) <= MAX_GRAM_SIZE:
+                grams.add(token)
+            else:
+                grams.update(gram for gram in _get_grams(token)
+                             if len(gram) == MAX_GRAM_SIZE)
+        candidates = None
+        # start with the less used grams, to intersect smaller sets
+        for gram in sorted(grams,
+                           key=lambda gram: len(self._postings.get(gram, ()))):
+            doc_ids = self._postings.get(gram)
+            if not doc_ids:
+                return set()
+            if candidates is None:
+                candidates = set(doc_ids)
+            else:
+                candidates &= doc_ids
+        if candidates is None:
+            # the word has only punctuation
+            candidates = set(self._texts.keys())
+        # the grams can be in the document but not together
+        return set(doc_id for doc_id in candidates
+                   if word in self._texts[doc_id])
@@ -0,0 +1,118 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Keep the thumbnails of the media files displayed in the choosers.
+
+The thumbnails are stored as png files in the activity data directory,
+named like in the freedesktop thumbnail specification, with the md5 of
+the uri, but also including the mtime and the size of the file, then a
+modified file gets a new thumbnail. The thumbnails are created in
+a background thread with low priority, to not block the user interface
+decoding the images."""
+
+import errno
+import hashlib
+import logging
+import os
+import threading
+import urllib
+
+from gi.repository import GdkPixbuf
+
+from sugar3.activity import activity
+
+from workqueue import WorkQueue
+from workqueue import PRIORITY_LOW
+
+# the thread ends when all the thumbnails are created
+_queue = WorkQueue(keep_threads=False)
+# the thumbnails being created, by path
+_pending = set()
+
+
+def _get_thumbnails_directory(width, height):
+    # every size is stored in a different directory
+    return os.path.join(activity.get_activity_root(), 'data', 'thumbnails',
+                        '%dx%d' % (width, height))
+
+
+def get_thumbnail_path(path, mtime, size, width, height):
+    uri = 'file://' + urllib.quote(os.path.abspath(path))
+    key = hashlib.md5('%s %d %d' % (uri, int(mtime), size)).hexdigest()
+    return os.path.join(_get_thumbnails_directory(width, height),
+                        key + '.png')
+
+
+def lookup(path, width, height):
+    """
+    Return the path of the thumbnail of the file, if was created,
+    or None
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    thumbnail_path = get_thumbnail_path(path, stat.st_mtime, stat.st_size,
+                                        width, height)
+    if os.path.exists(thumbnail_path):
+        return thumbnail_path
+    return None
+
+
+def _create_thumbnail(job, path, thumbnail_path, width, height):
+    # executed in the worker thread
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
+        # write to other file and rename, to not read incomplete files
+        temp_path = '%s.%d.tmp' % (thumbnail_path,
+                                   threading.current_thread().ident)
+        pixbuf.savev(temp_path, 'png', [], [])
+        os.rename(temp_path, thumbnail_path)
+    except Exception:
+        logging.exception('Error creating the thumbnail of %s', path)
+    return path
+
+
+def _thumbnail_created_cb(job, path):
+    _pending.discard(path)
+
+
+def is_creating_thumbnails():
+    return bool(_pending)
+
+
+def create_thumbnails(files, width, height):
+    """
+    Create in background the thumbnails not available
+    files -- a list of tuples (path, mtime, size)
+    """
+    directory = _get_thumbnails_directory(width, height)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logging.exception('Error creating directory %s', directory)
+            return
+
+    for path, mtime, size in files:
+        if path in _pending:
+            continue
+        thumbnail_path = get_thumbnail_path(path, mtime, size, width, height)
+        if os.path.exists(thumbnail_path):
+            continue
+        _pending.add(path)
+        _queue.add(_create_thumbnail, (path, thumbnail_path, width, height),
+                   _thumbnail_created_cb, PRIORITY_LOW)
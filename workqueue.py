@@ -0,0 +1,129 @@
+# Copyright 2015 Gonzalo Odiard
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Run jobs in background threads and deliver the results in the
+main loop."""
+
+import logging
+import threading
+
+from gi.repository import GObject
+from gi.repository import GLib
+
+# lower values are executed first
+PRIORITY_HIGH = 0
+PRIORITY_DEFAULT = 100
+PRIORITY_LOW = 200
+
+GObject.threads_init()
+
+
+class Job():
+
+    def __init__(self, function, args, callback, priority, sequence):
+        self.function = function
+        self.args = args
+        self.callback = callback
+        self.priority = priority
+        # used to keep the order between jobs with the same priority
+        self._sequence = sequence
+        self.cancelled = False
+        self.result = None
+
+    def cancel(self):
+        """
+        Cancel the job, if it is already running the function can check
+        the cancelled attribute to stop early.
+        The callback is never called for a cancelled job.
+        """
+        self.cancelled = True
+
+    def get_sort_key(self):
+        return (self.priority, self._sequence)
+
+
+class WorkQueue():
+
+    def __init__(self, n_threads=1, keep_threads=True):
+        """
+        n_threads -- the max number of worker threads
+        keep_threads -- if False, the threads end when there are no jobs
+            to execute, and are started again when a job is added
+        """
+        self._n_threads = n_threads
+        self._keep_threads = keep_threads
+        self._threads = []
+        self._jobs = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+
+    def add(self, function, args=(), callback=None,
+            priority=PRIORITY_DEFAULT):
+        """
+        Add a job to the queue.
+        function -- is called in a worker thread, with the job as the
+            first argument, followed by args
+        callback -- if is not None, is called in the main loop with the
+            job and the value returned by function
+        Return the Job object.
+        """
+        with self._condition:
+            self._sequence += 1
+            job = Job(function, args, callback, priority, self._sequence)
+            self._jobs.append(job)
+            if len(self._threads) < self._n_threads:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return job
+
+    def set_priority(self, job, priority):
+        with self._condition:
+            job.priority = priority
+
+    def cancel_all(self):
+        with self._condition:
+            for job in self._jobs:
+                job.cancel()
+            self._jobs = []
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._jobs:
+                    if not self._keep_threads:
+                        self._threads.remove(threading.current_thread())
+                        return
+                    self._condition.wait()
+                job = min(self._jobs, key=lambda job: job.get_sort_key())
+                self._jobs.remove(job)
+
+            if job.cancelled:
+                continue
+            try:
+                job.result = job.function(job, *job.args)
+            except Exception:
+                logging.exception('Error executing job %s', job.function)
+                continue
+            if job.callback is not None and not job.cancelled:
+                GLib.idle_add(self.__job_done_cb, job)
+
+    def __job_done_cb(self, job):
+        if not job.cancelled:
+            job.callback(job, job.result)
+        return False